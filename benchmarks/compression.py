@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+@author: Tatroxitum
+"""
+# psacc-domoticz
+# Copyright (C) 2025 Tatroxitum
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# Transfer of /vehicles/trips and /vehicles/chargings with and without
+# compression (a reverse proxy compressing the psacc responses, see the
+# README), against the stub servers of benchmarks/stub_servers.py. The
+# PSACCCrawler of psacc-domoticz.py reads the history several times and the
+# median of the bytes received, of the http time (transfer and
+# decompression) and of the json decode time are reported for each size.
+#
+#   python3 benchmarks/compression.py --sizes 1000,10000,100000 --bandwidth 20
+
+import argparse
+import importlib.util
+import json
+import os
+import shutil
+import statistics
+import tempfile
+
+from history import END_DATE
+from stub_servers import StubServers
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "psacc-domoticz.py")
+PATHS = ("/vehicles/trips", "/vehicles/chargings")
+
+
+def load_script(path):
+    # The script name is not a valid module name
+    spec = importlib.util.spec_from_file_location("psacc_domoticz", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def quiet(string="", st=None, end=None, args=None, fields=None):
+    pass
+
+
+def measure(script, trips, compress, args):
+    stub = StubServers(
+        trips, max(1, trips // 5), args.latency / 1000, seed=args.seed, compress=compress,
+        bandwidth=args.bandwidth * 125000, end_date=args.end_date,
+    ).start()
+    folder = tempfile.mkdtemp(prefix="psacc-domoticz-compression-")
+    configuration = stub.configuration(folder)
+    configuration["json_decoder"] = args.decoder
+    received, http, decode = [], [], []
+    try:
+        crawler = script.PSACCCrawler(configuration, super_print=quiet)
+        for _ in range(args.runs):
+            script.profiler.reset()
+            if crawler.get_vehicletrips() is False or crawler.get_vehiclechargesessions() is False:
+                raise RuntimeError("psacc stub error")
+            entries = script.profiler.entries
+            received.append(sum(entries["http psacc " + path]["bytes"] for path in PATHS))
+            http.append(sum(entries["http psacc " + path]["seconds"] for path in PATHS))
+            decode.append(sum(entries["json decode " + path]["seconds"] for path in PATHS))
+        decompressed = script.profiler.counters.get("psacc bytes decompressed", 0)
+    finally:
+        stub.stop()
+        shutil.rmtree(folder, ignore_errors=True)
+    return {
+        "trips": trips,
+        "compress": compress,
+        "bytes_received": int(statistics.median(received)),
+        "bytes_decompressed": decompressed,
+        "http_ms": round(statistics.median(http) * 1000, 2),
+        "decode_ms": round(statistics.median(decode) * 1000, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Transfer of the psacc history with and without compression")
+    parser.add_argument("--runs", type=int, default=5, help="number of runs, the median is reported (5)")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="comma separated numbers of trips (1000,10000,100000)")
+    parser.add_argument("--latency", type=float, default=0.0, help="latency of each response in milliseconds (0)")
+    parser.add_argument("--bandwidth", type=float, default=0.0, help="bandwidth of the responses in Mbit/s (unlimited)")
+    parser.add_argument("--decoder", default="json", help="json_decoder of the configuration (json)")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the history generator (1)")
+    parser.add_argument("--end-date", default=END_DATE, help="end of the history, iso date in UTC or now (" + END_DATE + ")")
+    parser.add_argument("--script", default=SCRIPT, help="script to measure (" + SCRIPT + ")")
+    parser.add_argument("--output", help="save the result as json in this file")
+    args = parser.parse_args()
+
+    script = load_script(args.script)
+    results = []
+    print("%10s %9s %14s %14s %10s %10s %10s" % (
+        "trips", "compress", "bytes", "decompressed", "http ms", "decode ms", "total ms",
+    ))
+    for trips in [int(size) for size in args.sizes.split(",")]:
+        for compress in (False, True):
+            result = measure(script, trips, compress, args)
+            results.append(result)
+            print("%10d %9s %14d %14d %10.2f %10.2f %10.2f" % (
+                trips, "gzip" if compress else "no", result["bytes_received"], result["bytes_decompressed"],
+                result["http_ms"], result["decode_ms"], result["http_ms"] + result["decode_ms"],
+            ))
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+@author: Tatroxitum
+"""
+# psacc-domoticz
+# Copyright (C) 2025 Tatroxitum
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# End to end benchmark of psacc-domoticz.py against the local stub psacc and
+# domoticz servers of benchmarks/stub_servers.py. The whole script is run
+# several times and the median of the wall time, cpu time and peak RSS of the
+# process are reported with the number of requests per endpoint.
+# By default each run starts without state (the whole history is processed),
+# with --incremental the state of a first run is kept (the usual cron run).
+#
+#   python3 benchmarks/e2e.py --trips 10000 --latency 20 --output before.json
+#   python3 benchmarks/e2e.py --trips 10000 --latency 20 --compare before.json
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from history import END_DATE
+from stub_servers import StubServers
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "psacc-domoticz.py")
+
+
+def run_once(script, folder, extra_args):
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, script, "--run", "-c", os.path.join(folder, "config.json"), "-l", folder] + extra_args,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    # wait4 gives the resources used by this process only
+    _, status, usage = os.wait4(process.pid, 0)
+    wall = time.perf_counter() - start
+    if os.waitstatus_to_exitcode(status) != 0:
+        with open(os.path.join(folder, "psacc-domoticz.log")) as log:
+            raise RuntimeError("psacc-domoticz.py failed :\n" + "".join(log.readlines()[-5:]))
+    # ru_maxrss is in kB on linux, in bytes on macos
+    rss_kb = usage.ru_maxrss / 1024 if sys.platform == "darwin" else usage.ru_maxrss
+    return wall, usage.ru_utime + usage.ru_stime, rss_kb
+
+
+def prepare_folder(folder, stub):
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+    with open(os.path.join(folder, "config.json"), "w") as config:
+        json.dump(stub.configuration(folder), config, indent=4)
+    # No check of the latest release on github during the benchmark
+    with open(os.path.join(folder, "psacc-domoticz.version.json"), "w") as version:
+        json.dump({"latest_release": {"tag_name": "", "name": "", "checked_at": time.time()}}, version)
+
+
+def measure(args):
+    stub = StubServers(
+        args.trips, args.chargings, args.latency / 1000, args.charging_status, seed=args.seed, compress=args.compress,
+        end_date=args.end_date,
+    ).start()
+    folder = tempfile.mkdtemp(prefix="psacc-domoticz-e2e-")
+    extra_args = ["--profile"] if args.profile else []
+    walls, cpus, rss = [], [], []
+    requests = {}
+    try:
+        prepare_folder(folder, stub)
+        if args.incremental:
+            run_once(args.script, folder, extra_args)
+        for _ in range(args.runs):
+            if not args.incremental:
+                prepare_folder(folder, stub)
+            stub.reset_counters()
+            wall, cpu, rss_kb = run_once(args.script, folder, extra_args)
+            walls.append(wall)
+            cpus.append(cpu)
+            rss.append(rss_kb)
+        requests = dict(sorted(stub.requests.items()))
+        bytes_sent = stub.bytes_sent
+    finally:
+        stub.stop()
+        shutil.rmtree(folder, ignore_errors=True)
+
+    version = subprocess.run([sys.executable, args.script, "--version"], capture_output=True, text=True).stdout
+    return {
+        "script_version": version.strip(),
+        "python": platform.python_version(),
+        "runs": args.runs,
+        "trips": args.trips,
+        "chargings": args.chargings,
+        "latency_ms": args.latency,
+        "incremental": args.incremental,
+        "compress": args.compress,
+        "seed": args.seed,
+        "end_date": args.end_date,
+        "wall_ms": round(statistics.median(walls) * 1000, 2),
+        "cpu_ms": round(statistics.median(cpus) * 1000, 2),
+        "peak_rss_kb": int(statistics.median(rss)),
+        "requests": sum(requests.values()),
+        "bytes_received": bytes_sent,
+        "requests_per_endpoint": requests,
+    }
+
+
+def scaling(args):
+    results = []
+    print("%10s %10s %12s %12s %12s %14s" % ("trips", "chargings", "wall ms", "cpu ms", "peak rss kB", "bytes"))
+    for size in [int(size) for size in args.sizes.split(",")]:
+        args.trips = size
+        args.chargings = max(1, size // 5)
+        result = measure(args)
+        results.append(result)
+        print("%10d %10d %12.2f %12.2f %12d %14d" % (
+            size, args.chargings, result["wall_ms"], result["cpu_ms"], result["peak_rss_kb"], result["bytes_received"],
+        ))
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End to end benchmark of psacc-domoticz.py against stub servers")
+    parser.add_argument("--runs", type=int, default=5, help="number of runs, the median is reported (5)")
+    parser.add_argument("--trips", type=int, default=100, help="number of trips of the history (100)")
+    parser.add_argument("--chargings", type=int, default=20, help="number of charge sessions of the history (20)")
+    parser.add_argument("--latency", type=float, default=0.0, help="latency of each response in milliseconds (0)")
+    parser.add_argument("--charging-status", default="Disconnected", help="charging status of the vehicle (Disconnected)")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the history generator (1)")
+    parser.add_argument("--end-date", default=END_DATE, help="end of the history, iso date in UTC or now (" + END_DATE + ")")
+    parser.add_argument(
+        "--sizes",
+        help="comma separated numbers of trips, to measure how the run scales with the history (one charge session every 5 trips)",
+    )
+    parser.add_argument("--incremental", action="store_true", help="keep the state between the runs")
+    parser.add_argument("--compress", action="store_true", help="compress the psacc responses of the stub (gzip)")
+    parser.add_argument("--profile", action="store_true", help="run the script with --profile")
+    parser.add_argument("--script", default=SCRIPT, help="script to measure (" + SCRIPT + ")")
+    parser.add_argument("--output", help="save the result as json in this file")
+    parser.add_argument("--compare", help="compare with a result previously saved with --output")
+    parser.add_argument("--threshold", type=float, default=10.0, help="regression threshold in percent (10)")
+    args = parser.parse_args()
+
+    if args.sizes:
+        scaling(args)
+        return
+
+    result = measure(args)
+    print("%-40s %12s" % ("psacc-domoticz " + result["script_version"], ""))
+    print("%-40s %12s" % ("history (trips / charge sessions)", "%d / %d" % (args.trips, args.chargings)))
+    print("%-40s %12.2f" % ("wall time ms (median)", result["wall_ms"]))
+    print("%-40s %12.2f" % ("cpu time ms (median)", result["cpu_ms"]))
+    print("%-40s %12d" % ("peak rss kB (median)", result["peak_rss_kb"]))
+    print("%-40s %12d" % ("requests (last run)", result["requests"]))
+    print("%-40s %12d" % ("bytes received (last run)", result["bytes_received"]))
+    for name, count in result["requests_per_endpoint"].items():
+        print("  %-38s %12d" % (name, count))
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(result, output, indent=2)
+
+    if args.compare:
+        with open(args.compare) as reference_file:
+            reference = json.load(reference_file)
+        for key in ("trips", "chargings", "latency_ms", "incremental", "compress", "seed", "end_date"):
+            if reference.get(key) != result[key]:
+                print("WARNING : %s differs from the reference (%s / %s)" % (key, reference.get(key), result[key]))
+        regression = False
+        print("")
+        print("%-40s %10s %10s %8s" % ("compared with " + args.compare, "before", "after", "delta"))
+        for key in ("wall_ms", "cpu_ms", "peak_rss_kb", "requests"):
+            delta = (result[key] - reference[key]) / reference[key] * 100 if reference[key] else 0.0
+            print("%-40s %10.2f %10.2f %+7.1f%%" % (key, reference[key], result[key], delta))
+            if delta > args.threshold:
+                regression = True
+        if regression:
+            print("REGRESSION : more than %.0f%% worse" % (args.threshold,))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
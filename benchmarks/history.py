@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""
+@author: Tatroxitum
+"""
+# psacc-domoticz
+# Copyright (C) 2025 Tatroxitum
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# Synthetic history of a plug-in hybrid for the /vehicles/trips and
+# /vehicles/chargings payloads of psacc, with the same field names and date
+# format ('%a, %d %b %Y %H:%M:%S %Z') as psacc. The history is reproducible :
+# it ends at a fixed date (END_DATE, --end-date to change it, "now" for a
+# history ending now) and the same seed gives the same payloads. The most
+# recent rows are last as psacc returns them.
+#
+# Trips : 2 to 3 per day (more beyond 20 years of history), commutes on
+# weekdays and longer trips on weekends, electric while the battery range
+# allows it then in hybrid mode, with a consumption depending on the season
+# and on the speed.
+# Charge sessions : spread evenly over the same period, mostly at night, in
+# chronological order and never overlapping.
+#
+#   python3 benchmarks/history.py --trips 1000000 --trips-file trips.json --chargings-file chargings.json
+
+import argparse
+import json
+import math
+import random
+from datetime import datetime, timedelta, timezone
+
+PSACC_DATE_FORMAT = "%a, %d %b %Y %H:%M:%S GMT"
+VIN = "VR3STUB0000000000"
+# End of the history by default, in UTC
+END_DATE = "2025-01-01T12:00:00"
+TRIPS_PER_DAY = 2.5
+# Larger histories are denser rather than older
+MAX_HISTORY_DAYS = 20 * 365
+BATTERY_KWH = 12.4
+ELECTRIC_RANGE_KM = 55.0
+CHARGER_KW = 3.7
+KWH_PRICE = 0.2016
+
+
+# "now" or an iso date, in UTC without timezone
+def parse_end_date(value=END_DATE):
+    if value == "now":
+        return datetime.now(timezone.utc).replace(microsecond=0)
+    date = datetime.fromisoformat(value)
+    return date if date.tzinfo else date.replace(tzinfo=timezone.utc)
+
+
+def start_of_history(trips, now):
+    days = min(MAX_HISTORY_DAYS, max(1, math.ceil(trips / TRIPS_PER_DAY)))
+    return (now - timedelta(days=days)).replace(hour=0, minute=0, second=0, microsecond=0), days
+
+
+def generate_trips(count, seed=1, now=None):
+    now = now or parse_end_date()
+    rng = random.Random(seed)
+    first_day, days = start_of_history(count, now)
+    mileage = 1000.0
+    trip_id = 0
+    for day in range(days):
+        date = first_day + timedelta(days=day)
+        weekend = date.weekday() >= 5
+        # 1.0 in january, 0.0 in july : more consumption in winter
+        winter = (1 + math.cos((date.timetuple().tm_yday - 15) / 365.0 * 2 * math.pi)) / 2
+        # exact number of trips : the rounding error is carried over to the next day
+        trips_today = round((day + 1) * count / days) - round(day * count / days)
+        # (hour, kind) of the trips of the day
+        if weekend:
+            trips_of_day = [(rng.uniform(8, 20), "long" if rng.random() < 0.15 else "errand") for _ in range(trips_today)]
+        else:
+            trips_of_day = [(rng.gauss(7.8, 0.4), "commute"), (rng.gauss(17.8, 0.6), "commute")]
+            trips_of_day = (trips_of_day + [(rng.uniform(10, 21), "errand") for _ in range(trips_today)])[:trips_today]
+        range_left = ELECTRIC_RANGE_KM * (1 - 0.25 * winter)
+        for hour, kind in sorted(trips_of_day):
+            if kind == "long":
+                distance = rng.uniform(80, 350)
+            elif kind == "commute":
+                distance = rng.gauss(24, 4)
+            else:
+                distance = rng.uniform(2, 12)
+            distance = round(max(0.5, distance), 1)
+            speed = min(110.0, max(15.0, rng.gauss(35 + distance / 4, 8)))
+            kwh_100km = 14 + 5 * winter + max(0.0, speed - 70) * 0.12 + rng.uniform(-1, 1)
+            electric_km = min(distance, max(0.0, range_left))
+            fuel_km = distance - electric_km
+            range_left = range_left - electric_km
+            consumption = electric_km * kwh_100km / 100
+            consumption_fuel = fuel_km * (5.2 + 0.8 * winter + rng.uniform(-0.4, 0.4)) / 100
+            start = date + timedelta(hours=min(max(hour, 0.0), 23.5))
+            if start > now:
+                start = now - timedelta(minutes=count - trip_id)
+            trip_id = trip_id + 1
+            mileage = mileage + distance
+            yield {
+                "id": trip_id,
+                "start_at": start.strftime(PSACC_DATE_FORMAT),
+                "duration": round(distance / speed * 60, 1),
+                "speed_average": round(speed, 1),
+                "distance": distance,
+                "mileage": round(mileage, 1),
+                "consumption": round(consumption, 3),
+                "consumption_km": round(consumption / distance * 100, 2),
+                "consumption_fuel": round(consumption_fuel, 3),
+                "consumption_fuel_km": round(consumption_fuel / distance * 100, 2),
+                "altitude_diff": round(rng.gauss(0, 20)),
+            }
+
+
+def generate_chargings(count, trips=None, seed=1, now=None):
+    # Over the same period as the trips, or 2 days per session without trips
+    now = now or parse_end_date()
+    rng = random.Random(seed + 1)
+    first_day, days = start_of_history(trips if trips else count * 2 * TRIPS_PER_DAY, now)
+    period = days * 86400.0 / max(count, 1)
+    mileage = 1000.0
+    previous_stop = None
+    for i in range(count):
+        # each session has its own slot of the period : the starts are increasing and the sessions never overlap
+        start = first_day + timedelta(seconds=i * period)
+        if period >= 86400:
+            # mostly at night, sometimes during the day
+            hour = rng.gauss(21.5, 1) if rng.random() < 0.8 else rng.uniform(9, 18)
+            start = start.replace(hour=0, minute=0, second=0) + timedelta(hours=min(max(hour, 0.0), 23.9))
+        else:
+            # several sessions a day : in the first half of the slot, the second half is left for the charge
+            start = start + timedelta(seconds=rng.uniform(0, period / 2))
+        if previous_stop and start <= previous_stop:
+            # a late charge lasting past the night of the next one
+            start = previous_stop + timedelta(minutes=rng.randint(5, 30))
+        start_level = rng.randint(5, 60)
+        end_level = 100 if rng.random() < 0.85 else rng.randint(start_level + 5, 100)
+        kw = (end_level - start_level) / 100 * BATTERY_KWH
+        duration = timedelta(hours=kw / CHARGER_KW, minutes=rng.randint(1, 15))
+        charging_mode = "Slow"
+        if period < 86400 and duration.total_seconds() > period / 2 - 60:
+            # too many sessions for a home charger, on a quick charger until the end of the slot
+            duration = timedelta(seconds=max(60, period / 2 - 60))
+            charging_mode = "Quick"
+        stop = start + duration
+        if stop > now:
+            # the last session is in progress
+            stop = None
+            start = min(start, now - timedelta(minutes=30))
+            if previous_stop:
+                start = max(start, previous_stop + timedelta(minutes=1))
+        previous_stop = stop
+        mileage = mileage + period / 86400.0 * 40
+        yield {
+            "start_at": start.strftime(PSACC_DATE_FORMAT),
+            "stop_at": stop.strftime(PSACC_DATE_FORMAT) if stop else None,
+            "VIN": VIN,
+            "start_level": start_level,
+            "end_level": end_level,
+            "co2": round(kw * 60),
+            "kw": round(kw, 3),
+            "price": round(kw * KWH_PRICE, 4),
+            "charging_mode": charging_mode,
+            "mileage": round(mileage, 1),
+        }
+
+
+def dump(rows, output):
+    # Written row by row, a million rows are never in memory at once
+    output.write("[")
+    for i, row in enumerate(rows):
+        if i:
+            output.write(", ")
+        output.write(json.dumps(row))
+    output.write("]")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic psacc history (trips and charge sessions)")
+    parser.add_argument("--trips", type=int, default=1000, help="number of trips (1000)")
+    parser.add_argument("--chargings", type=int, help="number of charge sessions (one every 5 trips by default)")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the generator (1)")
+    parser.add_argument("--end-date", default=END_DATE, help="end of the history, iso date in UTC or now (" + END_DATE + ")")
+    parser.add_argument("--trips-file", default="trips.json", help="/vehicles/trips payload (trips.json)")
+    parser.add_argument("--chargings-file", default="chargings.json", help="/vehicles/chargings payload (chargings.json)")
+    args = parser.parse_args()
+
+    chargings = args.chargings if args.chargings is not None else max(1, args.trips // 5)
+    now = parse_end_date(args.end_date)
+    with open(args.trips_file, "w") as output:
+        dump(generate_trips(args.trips, args.seed, now), output)
+    with open(args.chargings_file, "w") as output:
+        dump(generate_chargings(chargings, args.trips, args.seed, now), output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+@author: Tatroxitum
+"""
+# psacc-domoticz
+# Copyright (C) 2025 Tatroxitum
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# Cold start benchmark of psacc-domoticz.py based on python -X importtime.
+# The script is started with --version (all the module level imports are
+# done, then it exits) several times, and the median of the import time and
+# of the process wall time are reported with the slowest top level imports.
+#
+#   python3 benchmarks/import_time.py --output before.json
+#   python3 benchmarks/import_time.py --compare before.json
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "psacc-domoticz.py")
+
+
+def run_once(script):
+    start = time.perf_counter()
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", script, "--version"],
+        capture_output=True,
+        text=True,
+    )
+    wall = time.perf_counter() - start
+    if process.returncode != 0:
+        raise RuntimeError("psacc-domoticz.py --version failed : " + process.stderr)
+
+    # "import time: self [us] | cumulative | imported package", nested imports are indented
+    top_level = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not name.startswith("  "):
+            top_level[name.strip()] = int(cumulative)
+    return wall, top_level, process.stdout.strip()
+
+
+def measure(script, runs):
+    walls = []
+    imports = []
+    modules = {}
+    version = ""
+    for _ in range(runs):
+        wall, top_level, version = run_once(script)
+        walls.append(wall)
+        imports.append(sum(top_level.values()))
+        for name, cumulative in top_level.items():
+            modules.setdefault(name, []).append(cumulative)
+    return {
+        "script_version": version,
+        "python": platform.python_version(),
+        "runs": runs,
+        "wall_ms": round(statistics.median(walls) * 1000, 2),
+        "import_ms": round(statistics.median(imports) / 1000, 2),
+        "top_imports_ms": dict(
+            sorted(
+                ((name, round(statistics.median(values) / 1000, 2)) for name, values in modules.items()),
+                key=lambda item: -item[1],
+            )[:15]
+        ),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the cold start (import time) of psacc-domoticz.py")
+    parser.add_argument("--runs", type=int, default=7, help="number of runs, the median is reported (7)")
+    parser.add_argument("--script", default=SCRIPT, help="script to measure (" + SCRIPT + ")")
+    parser.add_argument("--output", help="save the result as json in this file")
+    parser.add_argument("--compare", help="compare with a result previously saved with --output")
+    parser.add_argument("--threshold", type=float, default=10.0, help="regression threshold in percent (10)")
+    args = parser.parse_args()
+
+    result = measure(args.script, args.runs)
+    print("%-40s %10s" % ("psacc-domoticz " + result["script_version"], "ms"))
+    print("%-40s %10.2f" % ("process wall time (median)", result["wall_ms"]))
+    print("%-40s %10.2f" % ("imports (median)", result["import_ms"]))
+    for name, value in result["top_imports_ms"].items():
+        print("  %-38s %10.2f" % (name, value))
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(result, output, indent=2)
+
+    if args.compare:
+        with open(args.compare) as reference_file:
+            reference = json.load(reference_file)
+        regression = False
+        print("")
+        print("%-40s %10s %10s %8s" % ("compared with " + args.compare, "before", "after", "delta"))
+        for key in ("wall_ms", "import_ms"):
+            delta = (result[key] - reference[key]) / reference[key] * 100 if reference[key] else 0.0
+            print("%-40s %10.2f %10.2f %+7.1f%%" % (key, reference[key], result[key], delta))
+            if delta > args.threshold:
+                regression = True
+        if regression:
+            print("REGRESSION : cold start is more than %.0f%% slower" % (args.threshold,))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+"""
+@author: Tatroxitum
+"""
+# psacc-domoticz
+# Copyright (C) 2025 Tatroxitum
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# Self-check of the fast paths of the model of psacc-domoticz.py against the
+# straightforward ones they replace, the running totals of the state are
+# computed from their results :
+# - psacc_timestamp() and parse_psacc_date().timestamp() (strptime), on the
+#   dates of synthetic histories and on edge cases, valid or not
+# - ModelList.parse() column by column, with each json decoder installed,
+#   and the model objects parsed row by row : same values, None kept as None
+#   (nan in the columns, for the stop of a session in progress)
+# - the errors of invalid rows, which must name the same row and reason as
+#   the row by row parsing
+# The script exits with code 1 on a difference.
+#
+#   python3 benchmarks/model_check.py
+
+import argparse
+import importlib.util
+import json
+import os
+import sys
+
+from history import generate_chargings, generate_trips, parse_end_date
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "psacc-domoticz.py")
+
+DATES = [
+    "Thu, 01 Jan 1970 00:00:00 GMT",
+    "Wed, 31 Dec 1969 23:59:59 GMT",
+    "Thu, 29 Feb 2024 23:59:59 GMT",
+    "Fri, 31 Dec 2038 12:00:00 GMT",
+    "Sat, 1 Jan 2000 00:00:00 GMT",
+    "Mon, 01 Jan 2000 00:00:00 GMT",
+    "Sun, 31 Mar 2024 01:30:00 GMT",
+    "Sun, 27 Oct 2024 02:30:00 GMT",
+    "Sat, 01 Jan 2000 00:00:00 UTC",
+    # invalid
+    "Sat, 01 Jan 2000 24:00:00 GMT",
+    "Sat, 01 Jan 2000 00:60:00 GMT",
+    "Sat, 01 Jan 2000 00:00:61 GMT",
+    "Sat, 01 Jan 2000 -1:00:00 GMT",
+    "Sat, 01 Jan 2000 +1:00:00 GMT",
+    "Sat, 01 Jan 2000 1:2:3 GMT",
+    "Sat, 32 Jan 2000 00:00:00 GMT",
+    "Wed, 29 Feb 2023 00:00:00 GMT",
+    "Sat, 01 Foo 2000 00:00:00 GMT",
+    "Sat, 01 Jan 2000 00:00:00 CET",
+    "Sat, 01 Jan 2000 00:00:00",
+    "Sat,  01 Jan 2000 00:00:00 GMT",
+    "2000-01-01T00:00:00+00:00",
+    "",
+]
+
+
+def load_script(path):
+    # The script name is not a valid module name
+    spec = importlib.util.spec_from_file_location("psacc_domoticz", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# Result of a call : ("ok", value) or ("error", exception type)
+def outcome(function, *args):
+    try:
+        return "ok", function(*args)
+    except Exception as e:
+        return "error", type(e).__name__
+
+
+class Check:
+    def __init__(self):
+        self.failures = 0
+
+    def report(self, name, differences, count):
+        print("%-60s %s" % (name + " (" + str(count) + ")", "ok" if not differences else "FAILED"))
+        for difference in differences[:5]:
+            print("    " + difference)
+        self.failures = self.failures + (1 if differences else 0)
+
+
+def check_dates(script, check, dates):
+    differences = []
+    for date in dates:
+        fast = outcome(script.psacc_timestamp, date)
+        reference = outcome(lambda value: script.parse_psacc_date(value).timestamp(), date)
+        if fast != reference:
+            differences.append(repr(date) + " : " + str(fast) + " instead of " + str(reference))
+    check.report("psacc_timestamp == parse_psacc_date().timestamp()", differences, len(dates))
+
+
+def same(value, reference):
+    return value == reference and type(value) is type(reference) or value is None and reference is None
+
+
+def check_rows(script, check, decoder, name, model_list, data):
+    rows, get = decoder.decode_rows(data, model_list.model)
+    parsed = model_list.parse(rows, name, get)
+    reference = [model_list.model.parse(row) for row in json.loads(data)]
+    differences = []
+    if len(parsed) != len(reference):
+        differences.append(str(len(parsed)) + " rows instead of " + str(len(reference)))
+    for index, (row, expected) in enumerate(zip(parsed, reference)):
+        for field in model_list.model.__slots__:
+            if not same(getattr(row, field), getattr(expected, field)):
+                differences.append("%s %d %s : %r instead of %r" % (
+                    name, index, field, getattr(row, field), getattr(expected, field),
+                ))
+    nones = sum(1 for row in reference for field in model_list.model.__slots__ if getattr(row, field) is None)
+    check.report(
+        "%s.parse (%s) == %s.parse row by row, %d None" % (
+            model_list.__name__, decoder.library, model_list.model.__name__, nones,
+        ),
+        differences, len(reference),
+    )
+
+
+# Each case : the rows, one of them invalid
+def invalid_trips(trips):
+    missing = dict(trips[2])
+    del missing["distance"]
+    return [
+        ("missing field", trips[:2] + [missing] + trips[3:]),
+        ("null field", trips[:1] + [dict(trips[1], consumption_km=None)] + trips[2:]),
+        ("invalid number", trips[:3] + [dict(trips[3], distance="12,5")] + trips[4:]),
+        ("invalid date", trips[:4] + [dict(trips[4], start_at="2025-01-01")] + trips[5:]),
+        ("not an object", trips[:1] + [3] + trips[1:]),
+        ("null row", trips[:2] + [None] + trips[2:]),
+    ]
+
+
+def check_errors(script, check, decoder, trips):
+    differences = []
+    cases = invalid_trips(trips)
+    for case, rows in cases:
+        data = json.dumps(rows).encode()
+        # The error of the first invalid row parsed alone, or the row itself if it is not an object
+        expected = None
+        for index, row in enumerate(rows):
+            if not isinstance(row, dict):
+                expected = "invalid trip " + str(index) + " from psacc : " + str(row)[:100]
+                break
+            try:
+                script.Trip.parse(row)
+            except script.PsaccDataError as e:
+                expected = "invalid trip " + str(index) + " from psacc : " + str(e)
+                break
+        try:
+            decoded, get = decoder.decode_rows(data, script.Trip)
+            script.Trips.parse(decoded, "trip", get)
+            message = None
+        except script.PsaccDataError as e:
+            message = str(e)
+        if message != expected:
+            differences.append(case + " : " + repr(message) + " instead of " + repr(expected))
+    check.report("Trips.parse (" + decoder.library + ") errors of the invalid rows", differences, len(cases))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Self-check of the fast parsing of the psacc data")
+    parser.add_argument("--trips", type=int, default=20000, help="number of trips of the histories (20000)")
+    parser.add_argument("--script", default=SCRIPT, help="script to check (" + SCRIPT + ")")
+    args = parser.parse_args()
+
+    script = load_script(args.script)
+    check = Check()
+
+    dates = list(DATES)
+    histories = []
+    for seed, end_date in ((1, "2025-01-01T12:00:00"), (2, "2024-02-29T23:30:00"), (3, "now")):
+        end = parse_end_date(end_date)
+        trips = list(generate_trips(args.trips, seed, end))
+        chargings = list(generate_chargings(max(1, args.trips // 5), args.trips, seed, end))
+        # a session in progress
+        chargings[-1]["stop_at"] = None
+        histories.append((trips, chargings))
+        dates.extend(trip["start_at"] for trip in trips)
+        dates.extend(date for charging in chargings for date in (charging["start_at"], charging["stop_at"]) if date)
+    check_dates(script, check, dates)
+
+    for library in script.JsonDecoder.LIBRARIES:
+        decoder = script.JsonDecoder(library)
+        try:
+            decoder.decode(b"[]")
+        except RuntimeError:
+            print("%-60s %s" % ("json decoder " + library, "not installed"))
+            continue
+        for trips, chargings in histories:
+            check_rows(script, check, decoder, "trip", script.Trips, json.dumps(trips).encode())
+            check_rows(script, check, decoder, "charge session", script.ChargeSessions, json.dumps(chargings).encode())
+        check_errors(script, check, decoder, histories[0][0][:10])
+
+    if check.failures:
+        print(str(check.failures) + " check(s) FAILED")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
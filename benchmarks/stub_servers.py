@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""
+@author: Tatroxitum
+"""
+# psacc-domoticz
+# Copyright (C) 2025 Tatroxitum
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# Local stand-in servers for the psacc endpoints (/get_vehicleinfo/<VIN>,
+# /vehicles/trips, /vehicles/chargings, /wakeup/<VIN>) and the domoticz
+# json.htm api, with a configurable latency. Used by benchmarks/e2e.py, they
+# can also be started alone to run psacc-domoticz.py by hand :
+#
+#   python3 benchmarks/stub_servers.py --trips 1000 --latency 20
+#   (then use the config.json printed by the command)
+#
+# With --compress the psacc responses are compressed (gzip or deflate, as
+# asked by Accept-Encoding), as a reverse proxy in front of psacc would.
+# --bandwidth limits the throughput of the responses, the loopback is much
+# faster than the network between psacc and psacc-domoticz.
+
+import argparse
+import gzip
+import json
+import threading
+import time
+import zlib
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from history import END_DATE, VIN, generate_chargings, generate_trips, parse_end_date
+
+# idx of the domoticz devices of the configuration -> fields of the device returned by getdevices
+DEVICES = {
+    "domoticz_idx_battery": ("1", {"Type": "General", "SubType": "Percentage"}),
+    "domoticz_idx_battery_autonomy": ("2", {"Type": "General", "SubType": "Custom Sensor"}),
+    "domoticz_idx_fuel": ("3", {"Type": "General", "SubType": "Percentage"}),
+    "domoticz_idx_fuel_autonomy": ("4", {"Type": "General", "SubType": "Custom Sensor"}),
+    "domoticz_idx_odometer": ("5", {"Type": "RFXMeter", "SubType": "RFXMeter counter", "SwitchTypeVal": 3}),
+    "domoticz_idx_electric_odometer": ("6", {"Type": "RFXMeter", "SubType": "RFXMeter counter", "SwitchTypeVal": 3}),
+    "domoticz_idx_hybrid_odometer": ("7", {"Type": "RFXMeter", "SubType": "RFXMeter counter", "SwitchTypeVal": 3}),
+    "domoticz_idx_charging_status": ("8", {"Type": "Lighting 1", "SubType": "X10"}),
+    "domoticz_idx_charging_consumption": ("9", {"Type": "RFXMeter", "SubType": "RFXMeter counter", "AddjValue2": 0.8942}),
+    "domoticz_idx_update_date": ("10", {"Type": "General", "SubType": "Text"}),
+    "domoticz_idx_air_temperature": ("11", {"Type": "Temp", "SubType": "LaCrosse TX3"}),
+    "domoticz_idx_rolling_trips_electric_consumption": ("20", {"Type": "General", "SubType": "Custom Sensor"}),
+    "domoticz_idx_rolling_trips_fuel_consumption": ("21", {"Type": "General", "SubType": "Custom Sensor"}),
+    "domoticz_idx_rolling_days_electric_consumption": ("22", {"Type": "General", "SubType": "Custom Sensor"}),
+    "domoticz_idx_rolling_days_fuel_consumption": ("23", {"Type": "General", "SubType": "Custom Sensor"}),
+    "domoticz_idx_trip_distance_quantiles": ("24", {"Type": "General", "SubType": "Text"}),
+    "domoticz_idx_trip_consumption_quantiles": ("25", {"Type": "General", "SubType": "Text"}),
+    "domoticz_idx_charging_eta": ("26", {"Type": "General", "SubType": "Text"}),
+    "domoticz_idx_charging_session_cost": ("27", {"Type": "General", "SubType": "Custom Sensor"}),
+    "domoticz_idx_charging_total_cost": ("28", {"Type": "General", "SubType": "Custom Sensor"}),
+}
+
+# Size of the chunks of the responses sent with a limited bandwidth
+CHUNK_SIZE = 16384
+
+
+def make_vehicleinfo(charging_status="Disconnected", now=None):
+    now = (now or datetime.now(timezone.utc)).isoformat()
+    return {
+        "timed_odometer": {"mileage": 12345.6, "updated_at": now},
+        "energy": [
+            {"type": "Electric", "level": 80, "autonomy": 50, "updated_at": now,
+             "charging": {"status": charging_status}},
+            {"type": "Fuel", "level": 40, "autonomy": 300, "updated_at": now,
+             "charging": {"status": "Disconnected"}},
+        ],
+        "environment": {"air": {"temp": 12}},
+    }
+
+
+class StubServers:
+    # psacc and domoticz answered by the same http server on 127.0.0.1
+    def __init__(self, trips=100, chargings=20, latency=0.0, charging_status="Disconnected", port=0, seed=1,
+                 compress=False, bandwidth=0, end_date=END_DATE):
+        # synthetic history of benchmarks/history.py, the vehicle data is always a recent one
+        now = datetime.now(timezone.utc).replace(microsecond=0)
+        end = parse_end_date(end_date)
+        self.bodies = {
+            "/get_vehicleinfo/" + VIN: json.dumps(make_vehicleinfo(charging_status, now)).encode(),
+            "/vehicles/trips": json.dumps(list(generate_trips(trips, seed, end))).encode(),
+            "/vehicles/chargings": json.dumps(list(generate_chargings(chargings, trips, seed, end))).encode(),
+            "/wakeup/" + VIN: b"true",
+        }
+        self.devices = dict(DEVICES.values())
+        self.latency = latency
+        self.compress = compress
+        # bytes per second of the responses, 0 : unlimited
+        self.bandwidth = bandwidth
+        # (path, encoding) -> compressed body, the history does not change
+        self.compressed = {}
+        self.requests = {}
+        self.bytes_sent = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), self.handler())
+        self.url = "http://127.0.0.1:%d" % (self.server.server_address[1],)
+
+    def handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                query = parse_qs(url.query)
+                if url.path == "/json.htm":
+                    name = "domoticz " + query.get("param", [""])[0]
+                    body = stub.domoticz(query)
+                else:
+                    name = "psacc " + url.path.replace(VIN, "<VIN>")
+                    body = stub.bodies.get(url.path)
+                encoding = None
+                if body is not None and stub.compress and url.path != "/json.htm":
+                    encoding, body = stub.encode(url.path, body, self.headers.get("Accept-Encoding", ""))
+                if stub.latency:
+                    time.sleep(stub.latency)
+                with stub.lock:
+                    stub.requests[name] = stub.requests.get(name, 0) + 1
+                    stub.bytes_sent += len(body or b"")
+                if body is None:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                if encoding:
+                    self.send_header("Content-Encoding", encoding)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                if not stub.bandwidth:
+                    self.wfile.write(body)
+                    return
+                for offset in range(0, len(body), CHUNK_SIZE):
+                    chunk = body[offset:offset + CHUNK_SIZE]
+                    time.sleep(len(chunk) / stub.bandwidth)
+                    self.wfile.write(chunk)
+
+        return Handler
+
+    # gzip, or deflate, if the client accepts it, like gzip_types application/json of nginx
+    def encode(self, path, body, accept_encoding):
+        accepted = [e.split(";")[0].strip() for e in accept_encoding.lower().split(",")]
+        encoding = "gzip" if "gzip" in accepted else "deflate" if "deflate" in accepted else None
+        if encoding is None:
+            return None, body
+        with self.lock:
+            if (path, encoding) not in self.compressed:
+                compress = gzip.compress if encoding == "gzip" else zlib.compress
+                self.compressed[(path, encoding)] = compress(body, 6)
+            return encoding, self.compressed[(path, encoding)]
+
+    def domoticz(self, query):
+        if query.get("param", [""])[0] != "getdevices":
+            return b'{"status": "OK"}'
+        rid = query.get("rid", ["0"])[0]
+        device = {
+            "idx": rid, "Name": "stub " + rid, "Type": "General", "SubType": "Custom Sensor",
+            "SwitchTypeVal": 0, "AddjValue": 0, "AddjValue2": 0, "Status": "Off",
+        }
+        device.update(self.devices.get(rid, {}))
+        return json.dumps({"status": "OK", "result": [device]}).encode()
+
+    def configuration(self, download_folder):
+        configuration = {
+            "psacc_server": self.url,
+            "VIN": VIN,
+            "domoticz_server": self.url,
+            "domoticz_login": "",
+            "domoticz_password": "",
+            "download_folder": download_folder,
+        }
+        for key, (idx, _) in DEVICES.items():
+            configuration[key] = idx
+        return configuration
+
+    def reset_counters(self):
+        with self.lock:
+            self.requests = {}
+            self.bytes_sent = 0
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stub psacc and domoticz servers")
+    parser.add_argument("--port", type=int, default=8765, help="port of the servers (8765)")
+    parser.add_argument("--trips", type=int, default=100, help="number of trips of the history (100)")
+    parser.add_argument("--chargings", type=int, default=20, help="number of charge sessions of the history (20)")
+    parser.add_argument("--latency", type=float, default=0.0, help="latency of each response in milliseconds (0)")
+    parser.add_argument("--charging-status", default="Disconnected", help="charging status of the vehicle (Disconnected)")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the history generator (1)")
+    parser.add_argument("--end-date", default=END_DATE, help="end of the history, iso date in UTC or now (" + END_DATE + ")")
+    parser.add_argument("--compress", action="store_true", help="compress the psacc responses (gzip or deflate)")
+    parser.add_argument("--bandwidth", type=float, default=0.0, help="bandwidth of the responses in Mbit/s (unlimited)")
+    args = parser.parse_args()
+
+    stub = StubServers(
+        args.trips, args.chargings, args.latency / 1000, args.charging_status, args.port, args.seed, args.compress,
+        args.bandwidth * 125000, args.end_date,
+    )
+    print(json.dumps(stub.configuration("."), indent=4))
+    try:
+        stub.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
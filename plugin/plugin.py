@@ -0,0 +1,275 @@
+"""
+<plugin key="psacc-domoticz" name="psacc-domoticz (Stellantis vehicles from psa_car_controller)" author="Tatroxitum" version="0.1.1" externallink="https://github.com/Tatroxitum/psacc-domoticz">
+    <description>
+        Updates the devices of the vehicle from the psa_car_controller server (psacc), in-process.
+        The devices are created by the plugin. Optional parameters of config.json (tariff_bands,
+        rolling_trips_window, run_deadline...) can be given as json in "Options".
+    </description>
+    <params>
+        <param field="Address" label="psacc server" width="300px" required="true" default="http://127.0.0.1"/>
+        <param field="Port" label="psacc port" width="75px" required="true" default="5000"/>
+        <param field="Mode1" label="VIN" width="200px" required="true"/>
+        <param field="Mode2" label="Polling interval (seconds)" width="75px" default="600"/>
+        <param field="Mode3" label="psacc database (optional)" width="300px" default=""/>
+        <param field="Mode4" label="Options (json)" width="400px" default="{}"/>
+        <param field="Mode6" label="Debug" width="75px">
+            <options>
+                <option label="False" value="0" default="true"/>
+                <option label="True" value="1"/>
+            </options>
+        </param>
+    </params>
+</plugin>
+"""
+# psacc-domoticz
+# Copyright (C) 2025 Tatroxitum
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# Domoticz python plugin mode of psacc-domoticz.py : the PSACCCrawler and the
+# devices mapping of DomoticzInjector are reused, the devices are updated
+# through the plugin api (Devices[unit].Update) instead of the json.htm api.
+# Install : link this folder in domoticz/plugins, for example
+#   ln -s /YOUR_INSTALLATION_PATH/psacc-domoticz/plugin /YOUR_DOMOTICZ_PATH/plugins/psacc-domoticz
+
+import importlib.util
+import json
+import os
+import time
+from urllib.parse import parse_qs, urlsplit
+
+import Domoticz
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "psacc-domoticz.py")
+
+# unit, configuration key of the device, name, parameters of Domoticz.Device
+UNITS = [
+    (1, "domoticz_idx_odometer", "Odometer", {"Type": 113, "Subtype": 0, "Switchtype": 3,
+        "Options": {"ValueQuantity": "Distance", "ValueUnits": "km"}}),
+    (2, "domoticz_idx_electric_odometer", "Electric odometer", {"Type": 113, "Subtype": 0, "Switchtype": 3,
+        "Options": {"ValueQuantity": "Distance", "ValueUnits": "km"}}),
+    (3, "domoticz_idx_hybrid_odometer", "Hybrid odometer", {"Type": 113, "Subtype": 0, "Switchtype": 3,
+        "Options": {"ValueQuantity": "Distance", "ValueUnits": "km"}}),
+    (4, "domoticz_idx_battery", "Battery", {"TypeName": "Percentage"}),
+    (5, "domoticz_idx_battery_autonomy", "Battery autonomy", {"TypeName": "Custom", "Options": {"Custom": "1;km"}}),
+    (6, "domoticz_idx_fuel", "Fuel", {"TypeName": "Percentage"}),
+    (7, "domoticz_idx_fuel_autonomy", "Fuel autonomy", {"TypeName": "Custom", "Options": {"Custom": "1;km"}}),
+    (8, "domoticz_idx_air_temperature", "Air temperature", {"TypeName": "Temperature"}),
+    (9, "domoticz_idx_update_date", "Update date", {"TypeName": "Text"}),
+    (10, "domoticz_idx_charging_status", "Charging", {"TypeName": "Switch"}),
+    (11, "domoticz_idx_charging_consumption", "Charging consumption", {"Type": 113, "Subtype": 0, "Switchtype": 0}),
+    (12, "domoticz_idx_rolling_trips_electric_consumption", "Electric consumption (last trips)",
+        {"TypeName": "Custom", "Options": {"Custom": "1;kWh/100km"}}),
+    (13, "domoticz_idx_rolling_trips_fuel_consumption", "Fuel consumption (last trips)",
+        {"TypeName": "Custom", "Options": {"Custom": "1;L/100km"}}),
+    (14, "domoticz_idx_rolling_days_electric_consumption", "Electric consumption (last days)",
+        {"TypeName": "Custom", "Options": {"Custom": "1;kWh/100km"}}),
+    (15, "domoticz_idx_rolling_days_fuel_consumption", "Fuel consumption (last days)",
+        {"TypeName": "Custom", "Options": {"Custom": "1;L/100km"}}),
+    (16, "domoticz_idx_trip_distance_quantiles", "Trips distance", {"TypeName": "Text"}),
+    (17, "domoticz_idx_trip_consumption_quantiles", "Trips consumption", {"TypeName": "Text"}),
+    (18, "domoticz_idx_charging_session_cost", "Charging session cost", {"TypeName": "Custom", "Options": {"Custom": "1;EUR"}}),
+    (19, "domoticz_idx_charging_total_cost", "Charging total cost", {"TypeName": "Custom", "Options": {"Custom": "1;EUR"}}),
+    (20, "domoticz_idx_charging_eta", "Charging ETA", {"TypeName": "Text"}),
+]
+
+
+def load_script(path=SCRIPT):
+    # The script name is not a valid module name
+    spec = importlib.util.spec_from_file_location("psacc_domoticz", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+################################################################################
+# Output of the script classes to the domoticz log
+################################################################################
+class PluginOutput:
+    # The classes print a message in two calls : print(message, end="") then
+    # print(st="ok") with the status, the message is kept until the status
+    def __init__(self):
+        self.pending = ""
+
+    def print(self, string="", st=None, end=None, args=None, fields=None):
+        if args:
+            string = string % args
+        string = (self.pending + " " + string).strip()
+        if end is not None:
+            self.pending = string
+            return
+        self.pending = ""
+        if not string:
+            return
+        status = (st or "").upper().strip()
+        if status == "EE":
+            Domoticz.Error(string)
+        elif status == "WW":
+            Domoticz.Status(string)
+        else:
+            Domoticz.Log(string)
+
+
+################################################################################
+# Plugin of psacc-domoticz
+################################################################################
+class PsaccPlugin:
+    def __init__(self):
+        self.script = None
+        self.output = PluginOutput()
+        self.configuration = None
+        self.state = None
+        self.psaccserver = None
+        self.domoticzserver = None
+        self.freshness = None
+        self.snapshots = None
+        self.interval = 600
+        self.next_update = 0
+
+    def onStart(self):
+        debug = Parameters.get("Mode6") == "1"
+        if debug:
+            Domoticz.Debugging(1)
+        self.script = load_script()
+
+        # Same configuration as config.json, the devices idx are the units of the plugin
+        address = Parameters["Address"] if "://" in Parameters["Address"] else "http://" + Parameters["Address"]
+        self.configuration = json.loads(Parameters.get("Mode4") or "{}")
+        self.configuration.update({
+            "psacc_server": address + ":" + Parameters["Port"],
+            "VIN": Parameters["Mode1"],
+            "psacc_database": Parameters.get("Mode3", ""),
+            "domoticz_server": "plugin",
+            "domoticz_login": "",
+            "domoticz_password": "",
+            "download_folder": Parameters["HomeFolder"],
+        })
+        for unit, key, name, device in UNITS:
+            self.configuration[key] = str(unit)
+            if unit not in Devices:
+                Domoticz.Device(Name=name, Unit=unit, Used=1, **device).Create()
+        self.interval = int(Parameters.get("Mode2") or 600)
+
+        self.state = self.script.StateStore(Parameters["HomeFolder"], super_print=self.output.print, debug=debug)
+        self.psaccserver = self.script.PSACCCrawler(self.configuration, super_print=self.output.print, debug=debug)
+        self.freshness = self.script.FreshnessPolicy(
+            self.configuration, self.state, super_print=self.output.print, debug=debug
+        )
+        self.snapshots = self.script.SnapshotDiff(
+            self.state, self.configuration.get("snapshot_max_age", 1800), super_print=self.output.print, debug=debug
+        )
+        self.domoticzserver = plugin_injector(self.script)(
+            self.configuration, super_print=self.output.print, debug=debug, state=self.state
+        )
+        # a heartbeat every 30 seconds (the longest domoticz allows), the updates are done every "interval"
+        Domoticz.Heartbeat(30)
+
+    def onHeartbeat(self):
+        if time.time() < self.next_update:
+            return
+        self.next_update = time.time() + self.interval
+        self.update()
+
+    # Same pipeline as run_pipeline() of the script, without blocking the
+    # plugin during the 90 seconds after a wakeup : the next update is
+    # scheduled instead
+    def update(self):
+        script = self.script
+        script.profiler.reset()
+        script.run_deadline.start(float(self.configuration.get("run_deadline", 60)))
+        try:
+            fromcache = self.freshness.use_cache()
+            vehicleinfo = self.psaccserver.get_vehicleinfo(fromcache=fromcache)
+            self.freshness.observe(vehicleinfo, fromcache)
+            vehicletrips = self.psaccserver.get_vehicletrips()
+            vehiclechargesessions = self.psaccserver.get_vehiclechargesessions(
+                since=self.domoticzserver.charge_accounting.since()
+            )
+            changes = self.snapshots.diff(vehicleinfo)
+            self.domoticzserver.update_devices(vehicleinfo, vehicletrips, vehiclechargesessions, changes)
+            self.snapshots.commit()
+            wakeup_reason = self.freshness.wakeup_reason(vehicleinfo)
+            wakeup_at = self.psaccserver.force_vehicle_update(wakeup_reason) if wakeup_reason else None
+            # the next update reads the data sent by the vehicle, from the psacc cache or live as the
+            # freshness policy allows. A wakeup merged with a pending one may already show in the vehicle data
+            if wakeup_at is not None and (self.script.FreshnessPolicy.data_date(vehicleinfo) or 0) < wakeup_at:
+                self.next_update = min(self.next_update, max(time.time(), wakeup_at + 90))
+            self.state.save()
+        except Exception as exc:
+            Domoticz.Error("psacc-domoticz update failed : " + str(exc))
+
+    def onStop(self):
+        if self.state is not None:
+            self.state.save()
+
+
+################################################################################
+# DomoticzInjector writing the devices through the plugin api
+################################################################################
+# The class of the script is only known once the script is loaded
+def plugin_injector(script):
+    class PluginInjector(script.DomoticzInjector):
+        # The json.htm commands used by DomoticzInjector, applied to Devices
+        def open_url(self, uri, data=None):
+            query = {k: v[0] for k, v in parse_qs(urlsplit(uri).query).items()}
+            command = query.get("param")
+            unit = int(query.get("idx") or query.get("rid") or 0)
+            start = time.perf_counter()
+            if command in ("udevice", "switchlight") and unit not in Devices:
+                raise RuntimeError("unit " + str(unit) + " does not exist")
+            if command == "udevice":
+                Devices[unit].Update(nValue=int(query.get("nValue", 0)), sValue=query.get("svalue", ""))
+                response = {"status": "OK"}
+            elif command == "switchlight":
+                on = query.get("switchcmd") == "On"
+                Devices[unit].Update(nValue=1 if on else 0, sValue="On" if on else "Off")
+                response = {"status": "OK"}
+            elif command == "getdevices" and unit in Devices:
+                device = Devices[unit]
+                response = {"status": "OK", "result": [{
+                    "idx": str(unit),
+                    "Name": device.Name,
+                    "Status": "On" if device.nValue else "Off",
+                    "Data": device.sValue,
+                }]}
+            elif command == "getversion":
+                response = {"status": "OK", "version": "plugin"}
+            else:
+                raise RuntimeError("unsupported command in plugin mode : " + uri)
+            self.last_call = {
+                "idx": str(unit) if unit else None,
+                "value": query.get("svalue") or query.get("switchcmd"),
+                "latency": round(time.perf_counter() - start, 4),
+            }
+            if command in ("udevice", "switchlight"):
+                script.profiler.count("device updates pushed")
+            return response
+
+    return PluginInjector
+
+
+_plugin = PsaccPlugin()
+
+
+def onStart():
+    _plugin.onStart()
+
+
+def onStop():
+    _plugin.onStop()
+
+
+def onHeartbeat():
+    _plugin.onHeartbeat()
@@ -0,0 +1,97 @@
+"""
+@author: Tatroxitum
+"""
+# psacc-domoticz
+# Copyright (C) 2025 Tatroxitum
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# Stand-in of the Domoticz module of the domoticz python plugin framework,
+# limited to what plugin/plugin.py uses, to run the plugin without domoticz
+# (see run_plugin.py). The devices are kept in Devices, the dictionary
+# domoticz gives to the plugin.
+
+import time
+
+Devices = {}
+heartbeat = 10
+debugging = 0
+
+
+def _log(level, message):
+    print(time.strftime("%Y-%m-%d %H:%M:%S") + " " + level + " : " + str(message))
+
+
+def Log(message):
+    _log("Status", message)
+
+
+def Status(message):
+    _log("Status", message)
+
+
+def Error(message):
+    _log("Error", message)
+
+
+def Debug(message):
+    if debugging:
+        _log("Debug", message)
+
+
+def Debugging(level):
+    global debugging
+    debugging = level
+
+
+def Heartbeat(seconds):
+    global heartbeat
+    heartbeat = min(int(seconds), 30)
+
+
+class Device:
+    def __init__(self, Name="", Unit=0, TypeName="", Type=0, Subtype=0, Switchtype=0, Image=0, Options=None, Used=0,
+                 DeviceID=""):
+        self.Name = Name
+        self.Unit = Unit
+        self.TypeName = TypeName
+        self.Type = Type
+        self.SubType = Subtype
+        self.SwitchType = Switchtype
+        self.Options = Options or {}
+        self.Used = Used
+        self.nValue = 0
+        self.sValue = ""
+        self.LastUpdate = ""
+        self.updates = 0
+
+    def Create(self):
+        if self.Unit in Devices:
+            Error("Unit " + str(self.Unit) + " already exists")
+            return
+        Devices[self.Unit] = self
+        Log("Device created : " + str(self.Unit) + " - " + self.Name)
+
+    def Update(self, nValue=0, sValue="", **kwargs):
+        self.nValue = nValue
+        self.sValue = sValue
+        self.LastUpdate = time.strftime("%Y-%m-%d %H:%M:%S")
+        self.updates = self.updates + 1
+
+    def Delete(self):
+        Devices.pop(self.Unit, None)
+
+    def __str__(self):
+        return "%3d %-36s nValue=%-3s sValue=%s" % (self.Unit, self.Name, self.nValue, self.sValue)
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+@author: Tatroxitum
+"""
+# psacc-domoticz
+# Copyright (C) 2025 Tatroxitum
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# Run plugin/plugin.py with the stub Domoticz module, as domoticz would :
+# Parameters and Devices are given to the plugin, then onStart and the
+# heartbeats are called. The devices are printed at the end. With the stub
+# servers of the benchmarks :
+#
+#   python3 benchmarks/stub_servers.py --port 8765 &
+#   python3 plugin/stub/run_plugin.py --address http://127.0.0.1 --port 8765 --vin VR3STUB0000000000
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+STUB_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, STUB_DIR)
+sys.path.insert(1, os.path.dirname(STUB_DIR))
+
+import Domoticz  # noqa: E402 the stub
+import plugin  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the psacc-domoticz plugin with a stub Domoticz module")
+    parser.add_argument("--address", default="http://127.0.0.1", help="psacc server (http://127.0.0.1)")
+    parser.add_argument("--port", default="5000", help="psacc port (5000)")
+    parser.add_argument("--vin", required=True, help="VIN of the vehicle")
+    parser.add_argument("--interval", default="600", help="polling interval in seconds (600)")
+    parser.add_argument("--database", default="", help="psacc database (none)")
+    parser.add_argument("--options", default="{}", help="options of the plugin, as json ({})")
+    parser.add_argument("--home", help="folder of the plugin, for the state (a temporary folder)")
+    parser.add_argument("--heartbeats", type=int, default=2, help="number of heartbeats to run (2)")
+    parser.add_argument("--fast", action="store_true", help="no wait between the heartbeats, and an update at each one")
+    parser.add_argument("--debug", action="store_true", help="debug mode of the plugin")
+    args = parser.parse_args()
+
+    home = args.home or tempfile.mkdtemp(prefix="psacc-domoticz-plugin-")
+    plugin.Parameters = {
+        "Address": args.address,
+        "Port": args.port,
+        "Mode1": args.vin,
+        "Mode2": args.interval,
+        "Mode3": args.database,
+        "Mode4": args.options,
+        "Mode6": "1" if args.debug else "0",
+        "HomeFolder": home + os.path.sep,
+    }
+    plugin.Devices = Domoticz.Devices
+
+    plugin.onStart()
+    for heartbeat in range(args.heartbeats):
+        if heartbeat:
+            if args.fast:
+                plugin._plugin.next_update = 0
+            else:
+                time.sleep(Domoticz.heartbeat)
+        plugin.onHeartbeat()
+    plugin.onStop()
+
+    print("")
+    for unit in sorted(Domoticz.Devices):
+        print(Domoticz.Devices[unit])
+
+
+if __name__ == "__main__":
+    main()
@@ -24,23 +24,33 @@ VERSION = "v0.1.1"
 # SCRIPT DEPENDENCIES
 ################################################################################
 
+# Imported first to measure the time spent importing the other modules
+import time
+IMPORT_START = time.perf_counter()
 
 try:
     import argparse
+    from array import array
+    import atexit
     import base64
+    import bisect
     import json
     import logging
+    import math
     import os
     import re
-    import requests
     import sys
-    import time
+    import threading
+    from collections import deque
+    from contextlib import contextmanager
+    from dataclasses import dataclass
     from datetime import datetime, timezone, timedelta
+    import logging.handlers
+    import queue
     from logging.handlers import RotatingFileHandler
-    from urllib.parse import urlencode
+    from urllib.parse import parse_qs, parse_qsl, urlencode, urlsplit
     import urllib3
-    from colorama import Fore, Style
-    
+
 except ImportError as exc:
     print(
         "Error: failed to import python required module : " + str(exc),
@@ -48,14 +58,753 @@ except ImportError as exc:
     )
     sys.exit(2)
 
+################################################################################
+# Profiler Class recording the time, bytes and http calls of each run phase
+################################################################################
+class RunProfiler:
+    def __init__(self):
+        # name -> {"kind", "calls", "seconds", "bytes", "errors"}, in the order of the first call
+        self.entries = {}
+        # [name, seconds, error] of each http call, for the latency histograms
+        self.calls = []
+        # name -> value of the event counters (devices updates pushed, skipped...)
+        self.counters = {}
+        # names of the phases in progress, innermost last
+        self.current = []
+
+    # Start the measures of a new run, for the long running modes
+    def reset(self):
+        self.__init__()
+
+    def add(self, name, seconds, nbytes=0, kind="phase", error=False):
+        entry = self.entries.setdefault(name, {"kind": kind, "calls": 0, "seconds": 0.0, "bytes": 0, "errors": 0})
+        entry["calls"] = entry["calls"] + 1
+        entry["seconds"] = entry["seconds"] + seconds
+        entry["bytes"] = entry["bytes"] + nbytes
+        if error:
+            entry["errors"] = entry["errors"] + 1
+        if kind == "http":
+            self.calls.append([name, seconds, error])
+
+    # Flag the last call of name as failed (when the error is only known after the call)
+    def mark_error(self, name):
+        self.entries[name]["errors"] = self.entries[name]["errors"] + 1
+        for call in reversed(self.calls):
+            if call[0] == name:
+                call[2] = True
+                break
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        self.current.append(name)
+        try:
+            yield
+        finally:
+            self.current.pop()
+            self.add(name, time.perf_counter() - start)
+
+    def report(self, total_seconds):
+        lines = ["%-52s %6s %10s %12s %6s" % ("phase", "calls", "seconds", "bytes", "errors")]
+        for kind, title in (("phase", "-- phases (inclusive)"), ("http", "-- http calls"), ("sqlite", "-- sqlite reads")):
+            lines.append(title)
+            for name, entry in self.entries.items():
+                if entry["kind"] == kind:
+                    lines.append("%-52s %6d %10.3f %12s %6s" % (
+                        name[:52], entry["calls"], entry["seconds"], entry["bytes"] or "", entry["errors"] or "",
+                    ))
+        http_entries = [entry for entry in self.entries.values() if entry["kind"] == "http"]
+        lines.append("%-52s %6d %10.3f %12d %6d" % (
+            "-- total (http calls / run)",
+            sum(entry["calls"] for entry in http_entries),
+            total_seconds,
+            sum(entry["bytes"] for entry in http_entries),
+            sum(entry["errors"] for entry in http_entries),
+        ))
+        for name, value in self.counters.items():
+            lines.append("%-52s %6d" % (name[:52], value))
+        return lines
+
+
+profiler = RunProfiler()
+profiler.add("imports", time.perf_counter() - IMPORT_START)
+
+
+################################################################################
+# Deadline of the whole run, shared by all the http calls
+################################################################################
+class DeadlineExceeded(RuntimeError):
+    pass
+
+
+class Deadline:
+    def __init__(self, budget=None):
+        self.budget = budget
+        self.end = None if budget is None else time.monotonic() + budget
+        # phase in progress when the deadline was exceeded
+        self.interrupted = None
+
+    def start(self, budget):
+        self.__init__(budget)
+
+    def remaining(self):
+        if self.end is None:
+            return float("inf")
+        return self.end - time.monotonic()
+
+    # Raise DeadlineExceeded if the budget is spent (a call shortened to the time left has just timed out)
+    def check(self):
+        if self.remaining() <= 0.01:
+            self.interrupted = profiler.current[-1] if profiler.current else None
+            raise DeadlineExceeded("run deadline of %ss exceeded" % (self.budget,))
+
+    # Timeout to use for a call : the configured one, shortened to the time left
+    def timeout(self, default):
+        self.check()
+        return min(float(default), self.remaining())
+
+    # Retries of a call : the ones of the pool, none if a retry would end after the deadline
+    def retries(self, timeout):
+        return None if self.remaining() >= 2 * timeout else False
+
+
+run_deadline = Deadline()
+
+
+################################################################################
+# Lock preventing two runs of the script to overlap
+################################################################################
+class RunLock:
+    def __init__(self, lock_folder=None):
+        lock_folder = (
+            os.path.dirname(os.path.realpath(__file__))
+            if lock_folder is None
+            else str(lock_folder).rstrip(os.path.sep)
+        )
+        self.lock_file = lock_folder + os.path.sep + "psacc-domoticz.lock"
+        self.__fd = None
+
+    # Return True if the lock is acquired, wait at most "wait" seconds for the other run to finish
+    def acquire(self, wait=0):
+        try:
+            import fcntl
+        except ImportError:
+            # No flock on this platform, runs are not protected
+            return True
+        self.__fd = open(self.lock_file, "a+")
+        end = time.monotonic() + wait
+        while True:
+            try:
+                fcntl.flock(self.__fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                if time.monotonic() >= end:
+                    self.__fd.close()
+                    self.__fd = None
+                    return False
+                time.sleep(1)
+            else:
+                # pid of the run holding the lock, for troubleshooting
+                self.__fd.seek(0)
+                self.__fd.truncate()
+                self.__fd.write(str(os.getpid()))
+                self.__fd.flush()
+                return True
+
+    def release(self):
+        if self.__fd is not None:
+            self.__fd.close()
+            self.__fd = None
+
+
+################################################################################
+# Watcher of the psacc data files, for the watch mode
+################################################################################
+class DataWatcher:
+    # inotify events of the folders of the files : modified, written, created, moved in
+    IN_EVENTS = 0x00000002 | 0x00000008 | 0x00000100 | 0x00000080
+
+    # The folders of the files are watched, sqlite writes in "<file>-wal" or
+    # "<file>-journal" and some files are replaced rather than modified.
+    # Without inotify (not linux) the mtime and size of the files are polled.
+    def __init__(self, files, debounce=10, poll_interval=5, super_print=None, debug=False):
+        self.__debug = debug
+
+        # Supersede local print function if provided as an argument
+        self.print = super_print if super_print else self.print
+
+        self.files = [os.path.realpath(f) for f in files]
+        self.names = set(os.path.basename(f) for f in self.files)
+        self.debounce = float(debounce)
+        self.poll_interval = float(poll_interval)
+        self.__fd = None
+        try:
+            self.__fd = self.__inotify()
+        except Exception as exc:
+            self.print("inotify is not available (" + str(exc) + "), the files are polled every "
+                + str(self.poll_interval) + "s", st="WW")
+        self.__snapshot = self.__stat()
+
+    def __inotify(self):
+        import ctypes
+        import ctypes.util
+
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        for folder in set(os.path.dirname(f) for f in self.files):
+            if libc.inotify_add_watch(fd, folder.encode(), self.IN_EVENTS) < 0:
+                os.close(fd)
+                raise OSError(ctypes.get_errno(), folder + " : " + os.strerror(ctypes.get_errno()))
+        return fd
+
+    # Read the pending inotify events, True if one of them is about a watched file
+    def __events(self):
+        changed = False
+        while True:
+            try:
+                data = os.read(self.__fd, 65536)
+            except BlockingIOError:
+                return changed
+            position = 0
+            while position < len(data):
+                # struct inotify_event : int wd, uint32 mask, uint32 cookie, uint32 len, char name[len]
+                name_length = int.from_bytes(data[position + 12:position + 16], sys.byteorder)
+                name = data[position + 16:position + 16 + name_length].rstrip(b"\0").decode(errors="replace")
+                position = position + 16 + name_length
+                for watched in self.names:
+                    if name == watched or name.startswith(watched + "-"):
+                        changed = True
+
+    def __stat(self):
+        snapshot = {}
+        for f in self.files:
+            for name in (f, f + "-wal", f + "-journal"):
+                try:
+                    stat = os.stat(name)
+                except OSError:
+                    continue
+                snapshot[name] = (stat.st_mtime_ns, stat.st_size)
+        return snapshot
+
+    # Wait for a change of the files at most "timeout" seconds, True if there was one
+    def __wait_change(self, timeout):
+        if self.__fd is not None:
+            import select
+
+            end = time.monotonic() + timeout
+            while True:
+                remaining = end - time.monotonic()
+                if remaining <= 0 or not select.select([self.__fd], [], [], remaining)[0]:
+                    return False
+                if self.__events():
+                    return True
+
+        end = time.monotonic() + timeout
+        while time.monotonic() < end:
+            time.sleep(max(0.0, min(self.poll_interval, end - time.monotonic())))
+            snapshot = self.__stat()
+            if snapshot != self.__snapshot:
+                self.__snapshot = snapshot
+                return True
+        return False
+
+    # Wait for the files to change, then for the end of the burst of writes :
+    # "debounce" seconds without change (or 6 times that since the first
+    # change, psacc may write continuously while driving).
+    # Return False if nothing changed within "timeout" seconds
+    def wait(self, timeout):
+        if not self.__wait_change(timeout):
+            return False
+        first_change = time.monotonic()
+        while time.monotonic() - first_change < 6 * self.debounce:
+            if not self.__wait_change(min(self.debounce, first_change + 6 * self.debounce - time.monotonic())):
+                break
+        if self.__debug:
+            self.print("psacc data changed", st="ok")
+        return True
+
+    def print(self, string="", st=None, end=None):
+        st = "[" + st + "] " if st else ""
+        if end is None:
+            print(st + string)
+        else:
+            print(st + string + " ", end="", flush="True")
+
+
+################################################################################
+# Adaptive polling : time of the next update from the latest vehicle state
+################################################################################
+class PollScheduler:
+    # Interval to the next update : short while charging or driving, medium
+    # after a recent trip, long when parked, and at least the quiet interval
+    # during the quiet hours ({"start": "23:00", "end": "06:00"}, local time).
+    # The date of the next update is persisted in the state : a cron run
+    # started before it exits at once.
+    def __init__(self, config_dict, state, super_print=None, debug=False):
+        self.__debug = debug
+
+        # Supersede local print function if provided as an argument
+        self.print = super_print if super_print else self.print
+
+        self.state = state.section("schedule")
+        self.intervals = {
+            "charging": float(config_dict.get("schedule_charging_interval", 120)),
+            "driving": float(config_dict.get("schedule_driving_interval", 120)),
+            "recent trip": float(config_dict.get("schedule_trip_interval", 300)),
+            "idle": float(config_dict.get("schedule_idle_interval", 1800)),
+            "quiet hours": float(config_dict.get("schedule_quiet_interval", 3600)),
+        }
+        self.recent_trip = float(config_dict.get("schedule_recent_trip", 3600))
+        quiet_hours = config_dict.get("schedule_quiet_hours") or {}
+        self.quiet_hours = None
+        if quiet_hours:
+            self.quiet_hours = (self.__minutes(quiet_hours["start"]), self.__minutes(quiet_hours["end"]))
+
+    def __minutes(self, hour_minute):
+        hours, minutes = str(hour_minute).split(":")
+        return int(hours) * 60 + int(minutes)
+
+    # End of the quiet hours if "timestamp" is within them, None otherwise
+    def quiet_end(self, timestamp):
+        if not self.quiet_hours:
+            return None
+        start, end = self.quiet_hours
+        local = datetime.fromtimestamp(timestamp)
+        minute = local.hour * 60 + local.minute
+        if not ((start <= minute < end) if start < end else (minute >= start or minute < end)):
+            return None
+        end_date = local.replace(hour=end // 60, minute=end % 60, second=0, microsecond=0)
+        if end_date <= local:
+            end_date = end_date + timedelta(days=1)
+        return end_date.timestamp()
+
+    # Seconds before the next update is due, 0 if it is due
+    def due_in(self, now=None):
+        now = time.time() if now is None else now
+        return max(0.0, float(self.state.get("next_due", 0)) - now)
+
+    # Plan the next update from the vehicle data of this run
+    def plan(self, vehicleinfo, vehicletrips=None, now=None):
+        now = time.time() if now is None else now
+        reason = "idle"
+        if vehicleinfo and vehicleinfo.charging:
+            reason = "charging"
+        elif vehicleinfo and vehicleinfo.moving:
+            reason = "driving"
+        elif vehicletrips:
+            trip = vehicletrips[-1]
+            if now - (trip.start + trip.duration * 60) < self.recent_trip:
+                reason = "recent trip"
+        next_due = now + self.intervals[reason]
+
+        quiet_end = self.quiet_end(now)
+        if quiet_end is not None:
+            reason = "quiet hours"
+            next_due = min(max(next_due, now + self.intervals[reason]), quiet_end)
+
+        self.state.update({"next_due": next_due, "reason": reason})
+        self.print("Next update at " + datetime.fromtimestamp(next_due).strftime("%H:%M:%S") + " (" + reason + ")", end="")
+        self.print(st="ok")
+        return next_due
+
+    def print(self, string="", st=None, end=None):
+        st = "[" + st + "] " if st else ""
+        if end is None:
+            print(st + string)
+        else:
+            print(st + string + " ", end="", flush="True")
+
+
+################################################################################
+# Freshness policy : psacc cache or live vehicle data, and when to wake up the vehicle
+################################################################################
+class FreshnessPolicy:
+    # The vehicle data is read from the psacc cache unless the last data seen
+    # is older than "freshness_max_age" ("freshness_charging_max_age" while
+    # charging) and no live read was done for "freshness_live_interval"
+    # seconds. A live read queries the Stellantis api : they are limited per
+    # 24 hours. The wakeups, which also wake up the vehicle (12 V battery),
+    # are limited by the WakeupManager.
+    def __init__(self, config_dict, state, super_print=None, debug=False):
+        self.__debug = debug
+
+        # Supersede local print function if provided as an argument
+        self.print = super_print if super_print else self.print
+
+        self.state = state.section("freshness")
+        self.max_age = float(config_dict.get("freshness_max_age", 3600))
+        self.charging_max_age = float(config_dict.get("freshness_charging_max_age", 900))
+        self.live_interval = float(config_dict.get("freshness_live_interval", 1800))
+        self.live_budget = int(config_dict.get("freshness_live_budget", 24))
+        self.wakeup_age = float(config_dict.get("freshness_wakeup_age", 600))
+        self.wakeup_enabled = bool(config_dict.get("domoticz_idx_charging_status"))
+
+    # Date (timestamp) of the most recent data of vehicleinfo, None if unknown
+    @staticmethod
+    def data_date(vehicleinfo):
+        return vehicleinfo.updated_at.timestamp() if vehicleinfo.updated_at else None
+
+    # Timestamps of the last 24 hours of a budget
+    def __spent(self, name, now):
+        spent = [at for at in self.state.get(name, []) if now - at < 86400]
+        self.state[name] = spent
+        return spent
+
+    def __age_text(self, age):
+        return "unknown age" if age is None else "age " + str(int(age // 60)) + " min"
+
+    # True to read the vehicle data from the psacc cache, False for a live read
+    def use_cache(self, now=None):
+        now = time.time() if now is None else now
+        data_date = self.state.get("data_date")
+        age = None if data_date is None else now - data_date
+        max_age = self.charging_max_age if self.state.get("charging") else self.max_age
+        live = self.__spent("live", now)
+        if age is not None and age < max_age:
+            reason = "fresh"
+        elif now - self.state.get("last_live", 0) < self.live_interval:
+            reason = "live read done " + str(int((now - self.state.get("last_live", 0)) // 60)) + " min ago"
+        elif len(live) >= self.live_budget:
+            reason = "live budget spent (" + str(len(live)) + "/" + str(self.live_budget) + ")"
+        else:
+            self.print("Live vehicle data (" + self.__age_text(age) + ", "
+                + str(len(live) + 1) + "/" + str(self.live_budget) + " in 24 h)", end="")
+            self.print(st="ok")
+            return False
+        if self.__debug:
+            self.print("Vehicle data from the psacc cache (" + self.__age_text(age) + ", " + reason + ")", end="")
+            self.print(st="ok")
+        return True
+
+    # Record the vehicle data read, and the live read if not from the cache
+    def observe(self, vehicleinfo, fromcache=True, now=None):
+        now = time.time() if now is None else now
+        if not fromcache:
+            self.__spent("live", now).append(now)
+            self.state["last_live"] = now
+        if vehicleinfo:
+            self.state["data_date"] = self.data_date(vehicleinfo)
+            self.state["charging"] = vehicleinfo.charging
+
+    # Reason to wake up the vehicle : charging with data older than
+    # "freshness_wakeup_age", None if a wakeup is not justified. As before the
+    # freshness policy, the vehicle is only woken up when the charging status
+    # is followed ("domoticz_idx_charging_status"). The wakeup itself is
+    # granted or not by the WakeupManager
+    def wakeup_reason(self, vehicleinfo, now=None):
+        now = time.time() if now is None else now
+        if not self.wakeup_enabled or not vehicleinfo or not vehicleinfo.charging:
+            return None
+        data_date = self.data_date(vehicleinfo)
+        age = None if data_date is None else now - data_date
+        if age is not None and age < self.wakeup_age:
+            if self.__debug:
+                self.print("No vehicle wakeup (charging, " + self.__age_text(age) + ", data is fresh)", end="")
+                self.print(st="ok")
+            return None
+        return "charging, " + self.__age_text(age)
+
+    def print(self, string="", st=None, end=None):
+        st = "[" + st + "] " if st else ""
+        if end is None:
+            print(st + string)
+        else:
+            print(st + string + " ", end="", flush="True")
+
+
+################################################################################
+# Wakeups of the vehicles : token bucket shared by the runs and the vehicles
+################################################################################
+class WakeupManager:
+    # A wakeup takes a token of a bucket of "wakeup_bucket_size" tokens
+    # refilled with one token every "wakeup_refill_interval" seconds, and a
+    # vehicle is not woken up again for "wakeup_cooldown" seconds : a request
+    # during the cooldown is refused. A wakeup is pending from its grant until
+    # psacc answers /wakeup : confirmed, it starts the cooldown, released (psacc
+    # refused or failed), its token is given back. A request while a wakeup is
+    # pending (overlapping runs) is merged with it, the caller reads the
+    # vehicle data once that wakeup had time to complete. The bucket is kept in psacc-domoticz.wakeups.json, locked while it
+    # is updated, so that overlapping runs and the runs of other vehicles
+    # (other config.json with the same "download_folder") share it.
+    # A pending wakeup older than this is considered lost (run killed during the /wakeup call)
+    PENDING_TIMEOUT = 120
+    def __init__(self, config_dict, state_folder=None, super_print=None, debug=False):
+        self.__debug = debug
+
+        # Supersede local print function if provided as an argument
+        self.print = super_print if super_print else self.print
+
+        state_folder = (
+            os.path.dirname(os.path.realpath(__file__))
+            if state_folder is None
+            else str(state_folder).rstrip(os.path.sep)
+        )
+        self.wakeups_file = state_folder + os.path.sep + "psacc-domoticz.wakeups.json"
+        self.size = float(config_dict.get("wakeup_bucket_size", 4))
+        self.refill_interval = float(config_dict.get("wakeup_refill_interval", 7200))
+        self.cooldown = float(config_dict.get("wakeup_cooldown", 1800))
+
+    # Read, update and write the bucket with the file locked
+    @contextmanager
+    def __locked(self):
+        with open(self.wakeups_file, "a+") as wakeups_file:
+            try:
+                import fcntl
+                fcntl.flock(wakeups_file, fcntl.LOCK_EX)
+            except ImportError:
+                # No flock on this platform, overlapping runs may both wake up the vehicle
+                pass
+            wakeups_file.seek(0)
+            try:
+                data = json.loads(wakeups_file.read() or "{}")
+            except ValueError:
+                data = {}
+            yield data
+            wakeups_file.seek(0)
+            wakeups_file.truncate()
+            json.dump(data, wakeups_file)
+
+    # Return (granted, since) : if granted the token is taken and the wakeup of
+    # "vin" is pending since "since" until confirm() or release(). Otherwise
+    # "since" is the date of the pending wakeup the request is merged with,
+    # None if the request is refused
+    def request(self, vin, reason="", now=None):
+        now = time.time() if now is None else now
+        with self.__locked() as data:
+            tokens = min(self.size, data.get("tokens", self.size) + (now - data.get("at", now)) / self.refill_interval)
+            last_wakeup = data.setdefault("vehicles", {}).get(vin, 0)
+            pending = data.setdefault("pending", {}).get(vin, 0)
+            data.update({"tokens": tokens, "at": now})
+            granted, since = False, None
+            if now - pending < self.PENDING_TIMEOUT:
+                since = pending
+                status = "merged"
+                why = "wakeup in flight since " + datetime.fromtimestamp(pending).strftime("%H:%M:%S")
+            elif now - last_wakeup < self.cooldown:
+                status = "refused"
+                why = "cooldown, last wakeup at " + datetime.fromtimestamp(last_wakeup).strftime("%H:%M:%S")
+            elif tokens < 1:
+                status = "refused"
+                why = "no token left, next one in " + str(int((1 - tokens) * self.refill_interval // 60)) + " min"
+            else:
+                granted, since = True, now
+                status = "granted"
+                data["tokens"] = tokens - 1
+                data["pending"][vin] = now
+                why = str(int(tokens - 1)) + " token(s) left"
+        reason = reason + ", " if reason else ""
+        self.print("Wakeup of " + vin + " " + status + " (" + reason + why + ")", end="")
+        self.print(st="WW" if since is None else "ok")
+        return granted, since
+
+    # psacc accepted the pending wakeup of "vin" : the cooldown of the vehicle starts
+    def confirm(self, vin):
+        with self.__locked() as data:
+            since = data.setdefault("pending", {}).pop(vin, None)
+            if since is not None:
+                data.setdefault("vehicles", {})[vin] = since
+
+    # The pending wakeup of "vin" did not happen : its token is given back
+    def release(self, vin):
+        with self.__locked() as data:
+            if data.setdefault("pending", {}).pop(vin, None) is not None:
+                data["tokens"] = min(self.size, data.get("tokens", 0) + 1)
+
+    def print(self, string="", st=None, end=None):
+        st = "[" + st + "] " if st else ""
+        if end is None:
+            print(st + string)
+        else:
+            print(st + string + " ", end="", flush="True")
+
+
+# One connection pool shared by all the http calls of the run (psacc, domoticz, github)
+shared_http_client = None
+
+# psacc does not compress its responses, a reverse proxy in front of it can
+PSACC_HEADERS = {"Accept-Encoding": "gzip, deflate"}
+
+def http_client():
+    global shared_http_client
+    if shared_http_client is None:
+        shared_http_client = urllib3.PoolManager(retries=1)
+    return shared_http_client
+
+# Body of a response requested with preload_content=False, decompressed chunk
+# by chunk while it is received, and the number of bytes received
+def read_streamed(response, chunk_size=65536):
+    if isinstance(response, BufferedResponse):
+        return response.data, len(response.data)
+    try:
+        data = b"".join(response.stream(chunk_size, decode_content=True))
+        return data, response.tell()
+    finally:
+        response.release_conn()
+
+
+################################################################################
+# Record and replay of the http traffic (psacc, domoticz), for tests and benchmarks
+################################################################################
+# Query parameters left out of the key of a call : the credentials, and the
+# values pushed to domoticz which change from one run to another
+TRAFFIC_VOLATILE_PARAMS = ("username", "password", "svalue", "nValue", "switchcmd")
+
+def traffic_key(method, url):
+    url = urlsplit(url)
+    query = [(k, v) for k, v in parse_qsl(url.query, keep_blank_values=True) if k not in TRAFFIC_VOLATILE_PARAMS]
+    return method + " " + url.path + ("?" + urlencode(sorted(query)) if query else "")
+
+
+class TrafficRecorder:
+    # Forward the calls to the real http client and save each response in
+    # record_folder : one file per response body and index.json listing the calls
+    def __init__(self, record_folder, client):
+        self.folder = str(record_folder).rstrip(os.path.sep)
+        self.client = client
+        self.calls = []
+        # the version check calls from a background thread
+        self.__lock = threading.Lock()
+        os.makedirs(self.folder, exist_ok=True)
+
+    def request(self, method, url, **kwargs):
+        start = time.perf_counter()
+        response = self.client.request(method, url, **kwargs)
+        latency = time.perf_counter() - start
+        # the body is read at once, also when the caller streams it (preload_content=False)
+        response = BufferedResponse(response.status, response.data)
+        with self.__lock:
+            body_file = "%04d.body" % (len(self.calls) + 1,)
+            with open(self.folder + os.path.sep + body_file, "wb") as body:
+                body.write(response.data)
+            self.calls.append({
+                "key": traffic_key(method, url),
+                "status": response.status,
+                "latency": round(latency, 6),
+                "file": body_file,
+            })
+            # The index is rewritten after each call, a run stopped on error is still replayable
+            index_file = self.folder + os.path.sep + "index.json"
+            with open(index_file + ".tmp", "w") as index:
+                json.dump({"version": VERSION, "calls": self.calls}, index, indent=1)
+            os.replace(index_file + ".tmp", index_file)
+        return response
+
+
+# Status and body of a response already read : recorded, replayed or streamed
+class BufferedResponse:
+    def __init__(self, status, data):
+        self.status = status
+        self.data = data
+
+
+class TrafficReplayer:
+    # Serve the responses saved by TrafficRecorder, without any network.
+    # The calls with the same key are served in the recorded order, the last
+    # one is served again if the run makes more calls than recorded.
+    # latency : seconds added to each call, or "recorded" for the latency of the recording
+    def __init__(self, record_folder, latency=0):
+        self.folder = str(record_folder).rstrip(os.path.sep)
+        self.latency = latency
+        with open(self.folder + os.path.sep + "index.json") as index:
+            calls = json.load(index)["calls"]
+        self.calls = {}
+        for call in calls:
+            self.calls.setdefault(call["key"], []).append(call)
+        self.served = {}
+        self.__lock = threading.Lock()
+
+    def request(self, method, url, **kwargs):
+        key = traffic_key(method, url)
+        if key not in self.calls:
+            raise urllib3.exceptions.HTTPError("no recorded response for " + key)
+        with self.__lock:
+            position = self.served.get(key, 0)
+            self.served[key] = position + 1
+        call = self.calls[key][min(position, len(self.calls[key]) - 1)]
+        latency = call["latency"] if self.latency == "recorded" else float(self.latency)
+        if latency:
+            time.sleep(latency)
+        with open(self.folder + os.path.sep + call["file"], "rb") as body:
+            return BufferedResponse(call["status"], body.read())
+
 ################################################################################
 # Output Class in charge of managing all script output to file or console
 ################################################################################
+class LogLine:
+    # Message of a log record : it is only formatted, with the lazy %-style
+    # arguments, when the background writer outputs it
+    __slots__ = ("st", "pieces", "phase", "fields")
+
+    def __init__(self, st, pieces, phase=None, fields=None):
+        self.st = st
+        self.pieces = pieces
+        self.phase = phase
+        self.fields = fields
+
+    def text(self):
+        strings = [string % args if args else string for string, args in self.pieces]
+        return ("".join(strings[:-1]).strip() + " " + strings[-1].strip()).strip()
+
+    def __str__(self):
+        strings = [string % args if args else string for string, args in self.pieces]
+        return "%s : %s %s" % (self.st.upper().lstrip(), "".join(strings[:-1]).strip(), strings[-1].strip())
+
+
+class JsonLinesFormatter(logging.Formatter):
+    # One json object per line : run id, phase, status, message and the
+    # structured fields of the line (device idx, value, latency...)
+    def __init__(self, run_id):
+        super().__init__()
+        self.run_id = run_id
+
+    def format(self, record):
+        line = {
+            "ts": datetime.fromtimestamp(record.created).astimezone().isoformat(timespec="milliseconds"),
+            "run_id": self.run_id,
+        }
+        if isinstance(record.msg, LogLine):
+            line["phase"] = record.msg.phase
+            line["status"] = record.msg.st.upper().strip()
+            line["message"] = record.msg.text()
+            # the fields never replace the keys of the formatter
+            for key, value in (record.msg.fields or {}).items():
+                line.setdefault(key, value)
+        else:
+            # Records of the libraries (urllib3 retries...)
+            line["status"] = record.levelname
+            line["message"] = record.getMessage()
+        return json.dumps(line, default=str)
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    # The default QueueHandler formats the record in the calling thread, keep it
+    # as is so that the formatting is done by the writer thread
+    def prepare(self, record):
+        return record
+
+
+# Short representation of a (possibly huge) psacc payload for the debug traces
+def debug_dump(data, max_items=3, max_chars=1000):
+    if isinstance(data, list) and len(data) > max_items:
+        string = "[%d items] %s ... %s" % (len(data), str(data[:max_items - 1])[:-1], str(data[-1]))
+    else:
+        string = str(data)
+    if len(string) > max_chars:
+        string = string[:max_chars] + "... (%d chars)" % (len(string),)
+    return string
+
+
 class Output:
-    def __init__(self, logs_folder=None, debug=False):
+    def __init__(self, logs_folder=None, debug=False, json_lines=False):
         self.__debug = debug
         self.__logger = logging.getLogger()
-        self.__print_buffer = ""
+        # Identifier of the run, to correlate the lines of a run in the json lines log
+        self.run_id = os.urandom(6).hex()
+        self.__print_buffer = []
         logs_folder = (
             os.path.dirname(os.path.realpath(__file__))
             if logs_folder is None
@@ -63,8 +812,15 @@ class Output:
         )
         logfile = logs_folder + "/psacc-domoticz.log"
 
-        # By default log to console
+        # By default log to console, in colors if colorama is installed
         self.print = self.__print_to_console
+        self.__colors = None
+        if self.__debug:
+            try:
+                from colorama import Fore, Style
+                self.__colors = {"OK": Fore.GREEN, "WW": Fore.YELLOW, "EE": Fore.RED, "": Style.RESET_ALL}
+            except ImportError:
+                pass
 
         # In standard mode log to a file
         if self.__debug is False:
@@ -77,49 +833,451 @@ class Output:
             # Set the logfile format
             file_handler = RotatingFileHandler(logfile, "a", 1000000, 1)
             formatter = logging.Formatter("%(asctime)s : %(message)s")
+            if json_lines:
+                formatter = JsonLinesFormatter(self.run_id)
             file_handler.setFormatter(formatter)
+
+            # The records are queued and written by a background thread, the
+            # queue is flushed when the script exits
+            log_queue = queue.SimpleQueue()
+            self.__listener = logging.handlers.QueueListener(log_queue, file_handler)
+            self.__listener.start()
+            atexit.register(self.__listener.stop)
             self.__logger.setLevel(logging.INFO)
-            self.__logger.addHandler(file_handler)
+            self.__logger.addHandler(LazyQueueHandler(log_queue))
             self.print = self.__print_to_logfile
 
-    def __print_to_console(self, string="", st=None, end=None):
+    def __print_to_console(self, string="", st=None, end=None, args=None, fields=None):
+        if args:
+            string = string % args
         if st:
             st = st.upper()
-            st = st.replace("OK", Fore.GREEN + "OK")
-            st = st.replace("WW", Fore.YELLOW + "WW")
-            st = st.replace("EE", Fore.RED + "EE")
-            st = "[" + st + Style.RESET_ALL + "] "
+            if self.__colors:
+                st = st.replace("OK", self.__colors["OK"] + "OK")
+                st = st.replace("WW", self.__colors["WW"] + "WW")
+                st = st.replace("EE", self.__colors["EE"] + "EE")
+                st = st + self.__colors[""]
+            st = "[" + st + "] "
 
         if end is not None:
             st = st + " " if st else ""
             print(st + "%-75s" % (string,), end="", flush=True)
-            self.__print_buffer = self.__print_buffer + string
+            self.__print_buffer.append(string)
         elif self.__print_buffer:
             st = st if st else "[--] "
             print(st + string.rstrip())
-            self.__print_buffer = ""
+            self.__print_buffer = []
         else:
             st = st if st else "[--]"
             print(("{:75s}" + st).format(string.rstrip()))
-            self.__print_buffer = ""
+            self.__print_buffer = []
 
-    def __print_to_logfile(self, string="", st=None, end=None):
-        if end is not None:
-            self.__print_buffer = self.__print_buffer + string
-        else:
-            st = st if st else "--"
-            self.__logger.info(
-                "%s : %s %s",
-                st.upper().lstrip(),
-                self.__print_buffer.lstrip().rstrip(),
-                string.lstrip().rstrip()
-            )
-            self.__print_buffer = ""
+    def __print_to_logfile(self, string="", st=None, end=None, args=None, fields=None):
+        self.__print_buffer.append((string, args))
+        if end is None:
+            self.__logger.info(LogLine(
+                st if st else "--",
+                self.__print_buffer,
+                profiler.current[-1] if profiler.current else None,
+                dict(fields) if fields else None,
+            ))
+            self.__print_buffer = []
 
 
 def document_initialised(driver):
     return driver.execute_script("return true;")
 
+
+# Date format used by psacc in /vehicles/trips and /vehicles/chargings
+PSACC_DATE_FORMAT = '%a, %d %b %Y %H:%M:%S %Z'
+
+def parse_psacc_date(date_string):
+    # psacc dates are always GMT, return a timezone aware datetime
+    return datetime.strptime(date_string, PSACC_DATE_FORMAT).replace(tzinfo=timezone.utc)
+
+
+################################################################################
+# Typed model of the psacc data, parsed and validated once per fetch
+################################################################################
+class PsaccDataError(RuntimeError):
+    pass
+
+
+MISSING = object()
+
+# Value at "path" (keys separated by dots) of the psacc json converted by
+# "convert", "default" when it is missing or null
+def data_field(data, path, convert=float, default=MISSING):
+    value = data
+    for key in path.split("."):
+        value = value.get(key) if isinstance(value, dict) else None
+        if value is None:
+            if default is not MISSING:
+                return default
+            raise PsaccDataError('"' + path + '" is missing')
+    try:
+        return convert(value)
+    except (TypeError, ValueError) as e:
+        raise PsaccDataError('"' + path + '" is invalid : ' + str(e))
+
+
+def iso_date(date_string):
+    return datetime.fromisoformat(date_string)
+
+
+PSACC_MONTHS = {month: index + 1 for index, month in enumerate(
+    ("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+)}
+EPOCH_ORDINAL = datetime(1970, 1, 1).toordinal()
+
+# Timestamp of a psacc date, same result as parse_psacc_date() but several times
+# faster than strptime : every trip of the history is parsed at each run
+def psacc_timestamp(date_string):
+    try:
+        _, day, month, year, hms, zone = date_string.split(" ")
+        hours, minutes, seconds = hms.split(":")
+        # anything strptime would not accept (signs, out of range times...) goes to strptime for its error
+        if not (zone == "GMT" and len(year) == 4 and year.isdigit() and all(
+            0 < len(value) <= 2 and value.isdigit() for value in (day, hours, minutes, seconds)
+        ) and int(hours) < 24 and int(minutes) < 60 and int(seconds) < 60):
+            raise ValueError(date_string)
+        days = datetime(int(year), PSACC_MONTHS[month], int(day)).toordinal() - EPOCH_ORDINAL
+    except (AttributeError, KeyError, ValueError):
+        return parse_psacc_date(date_string).timestamp()
+    return days * 86400.0 + int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+
+
+@dataclass
+class EnergyEntry:
+    __slots__ = ("type", "level", "autonomy", "updated_at", "charging_status")
+    type: str
+    level: float
+    autonomy: float
+    updated_at: datetime
+    charging_status: str
+
+    @classmethod
+    def parse(cls, data):
+        return cls(
+            data_field(data, "type", str),
+            data_field(data, "level"),
+            data_field(data, "autonomy"),
+            data_field(data, "updated_at", iso_date),
+            data_field(data, "charging.status", str, None),
+        )
+
+    @property
+    def charging(self):
+        return self.charging_status == "InProgress"
+
+
+@dataclass
+class VehicleInfo:
+    # mileage, odometer_updated_at and air_temperature are None when psacc does not give them
+    __slots__ = ("mileage", "odometer_updated_at", "energies", "air_temperature", "moving")
+    mileage: float
+    odometer_updated_at: datetime
+    energies: tuple
+    air_temperature: float
+    moving: bool
+
+    @classmethod
+    def parse(cls, data):
+        if not isinstance(data, dict):
+            raise PsaccDataError("invalid vehicle info from psacc : " + str(data)[:100])
+        try:
+            return cls(
+                data_field(data, "timed_odometer.mileage", float, None),
+                data_field(data, "timed_odometer.updated_at", iso_date, None),
+                tuple(EnergyEntry.parse(energy) for energy in data.get("energy") or []),
+                data_field(data, "environment.air.temp", float, None),
+                data_field(data, "kinetic.moving", bool, False),
+            )
+        except PsaccDataError as e:
+            raise PsaccDataError("invalid vehicle info from psacc : " + str(e))
+
+    # Energy entry of "energy_type" (Electric or Fuel), None if the vehicle has none
+    def energy(self, energy_type):
+        for energy in self.energies:
+            if energy.type == energy_type:
+                return energy
+        return None
+
+    @property
+    def charging(self):
+        return any(energy.charging for energy in self.energies)
+
+    # Date of the most recent data, None if unknown
+    @property
+    def updated_at(self):
+        dates = [self.odometer_updated_at] + [energy.updated_at for energy in self.energies]
+        dates = [date for date in dates if date is not None]
+        return max(dates) if dates else None
+
+
+@dataclass
+class Trip:
+    __slots__ = ("start", "duration", "distance", "consumption_km", "consumption_fuel_km")
+    start: float
+    duration: float
+    distance: float
+    consumption_km: float
+    consumption_fuel_km: float
+
+    # json key, conversion and default of each field, in the order of __slots__ :
+    # the only fields of /vehicles/trips decoded by JsonDecoder.decode_rows()
+    FIELDS = (
+        ("start_at", psacc_timestamp, MISSING),
+        ("duration", float, 0.0),
+        ("distance", float, MISSING),
+        ("consumption_km", float, MISSING),
+        ("consumption_fuel_km", float, MISSING),
+    )
+
+    @classmethod
+    def parse(cls, data):
+        return cls(*(data_field(data, key, convert, default) for key, convert, default in cls.FIELDS))
+
+
+@dataclass
+class ChargeSession:
+    # stop is None while the session is in progress
+    __slots__ = ("start", "stop", "kw")
+    start: float
+    stop: float
+    kw: float
+
+    FIELDS = (
+        ("start_at", psacc_timestamp, MISSING),
+        ("stop_at", psacc_timestamp, None),
+        ("kw", float, 0.0),
+    )
+
+    @classmethod
+    def parse(cls, data):
+        return cls(*(data_field(data, key, convert, default) for key, convert, default in cls.FIELDS))
+
+
+class ModelList:
+    # Rows of a model stored as one array of doubles per field (None is stored
+    # as nan) : a few bytes per value instead of a dict per row. The model
+    # objects are built when the rows are read.
+    model = None
+
+    def __init__(self, rows=()):
+        self.columns = tuple(array("d") for _ in self.model.__slots__)
+        for row in rows:
+            self.append(row)
+
+    # rows : the decoded json rows, dicts or the projections of JsonDecoder.decode_rows()
+    # read with "get"
+    @classmethod
+    def parse(cls, rows, name="row", get=dict.get):
+        if not isinstance(rows, list):
+            raise PsaccDataError("invalid " + name + "s from psacc : " + str(rows)[:100])
+        model_list = cls()
+        try:
+            # Column by column, several times faster than building the model objects
+            for column, (key, convert, default) in zip(model_list.columns, cls.model.FIELDS):
+                values = [get(row, key) for row in rows]
+                if default is MISSING and None in values:
+                    raise PsaccDataError(key)
+                column.extend([math.nan if value is None else convert(value) for value in values]
+                    if default is None else [default if value is None else convert(value) for value in values])
+        except Exception:
+            # Row by row to tell which row is invalid
+            model_list = cls()
+            for index, row in enumerate(rows):
+                try:
+                    model_list.append(cls.model.parse({key: get(row, key) for key, _, _ in cls.model.FIELDS}))
+                except (AttributeError, TypeError):
+                    raise PsaccDataError("invalid " + name + " " + str(index) + " from psacc : " + str(row)[:100])
+                except PsaccDataError as e:
+                    raise PsaccDataError("invalid " + name + " " + str(index) + " from psacc : " + str(e))
+            raise
+        return model_list
+
+    def append(self, row):
+        for column, name in zip(self.columns, self.model.__slots__):
+            value = getattr(row, name)
+            column.append(math.nan if value is None else value)
+
+    def __len__(self):
+        return len(self.columns[0])
+
+    def __getitem__(self, index):
+        return self.model(*(None if value != value else value for value in (column[index] for column in self.columns)))
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def __reversed__(self):
+        for index in range(len(self) - 1, -1, -1):
+            yield self[index]
+
+    # Rows started after start (or at start too if inclusive), in chronological order, all of
+    # them when start is None : psacc returns the rows ordered by start date, the start column is
+    # walked back from the most recent row until start is reached
+    def since(self, start, inclusive=False):
+        starts = self.columns[self.model.__slots__.index("start")]
+        first = len(starts)
+        if start is None:
+            first = 0
+        while first > 0 and (starts[first - 1] >= start if inclusive else starts[first - 1] > start):
+            first = first - 1
+        return [self[index] for index in range(first, len(self))]
+
+
+class Trips(ModelList):
+    model = Trip
+
+
+class ChargeSessions(ModelList):
+    model = ChargeSession
+
+
+################################################################################
+# Decoding of the psacc json, with a faster library when one is installed
+################################################################################
+class JsonDecoder:
+    # "json_decoder" : auto (default) uses msgspec, then orjson, then json,
+    # the first one installed. The rows of the trips and the charge sessions
+    # are projected on the fields of the model while they are decoded :
+    # msgspec skips the other fields without decoding them, json keeps a dict
+    # of the fields of the model only. orjson has no projection but decodes
+    # the whole rows faster than json.
+    LIBRARIES = ("msgspec", "orjson", "json")
+
+    def __init__(self, library="auto", super_print=None, debug=False):
+        self.__debug = debug
+
+        # Supersede local print function if provided as an argument
+        self.print = super_print if super_print else self.print
+
+        if library not in ("auto",) + self.LIBRARIES:
+            raise RuntimeError('"json_decoder" must be auto, ' + ", ".join(self.LIBRARIES))
+        self.library = None
+        self.__module = None
+        self.__row_decoders = {}
+        # The libraries are imported at the first decoding only
+        self.__wanted = self.LIBRARIES if library == "auto" else (library,)
+
+    def __load(self):
+        if self.library is not None:
+            return
+        for library in self.__wanted:
+            try:
+                if library == "msgspec":
+                    import msgspec as module
+                elif library == "orjson":
+                    import orjson as module
+                else:
+                    module = json
+            except ImportError:
+                if library == self.__wanted[-1]:
+                    raise RuntimeError('"json_decoder" ' + library + " is not installed")
+                continue
+            self.library = library
+            self.__module = module
+            if self.__debug:
+                self.print("json decoded with " + library, st="ok")
+            return
+
+    # Decode a whole json document
+    def decode(self, data):
+        self.__load()
+        if self.library == "msgspec":
+            try:
+                return self.__module.json.decode(data)
+            except self.__module.MsgspecError as e:
+                raise PsaccDataError("invalid json from psacc : " + str(e))
+        return self.__module.loads(data)
+
+    # Decode a list of rows keeping only the fields of "model" (Trip, ChargeSession),
+    # return the rows and the function reading a field of a row
+    def decode_rows(self, data, model):
+        self.__load()
+        keys = [key for key, _, _ in model.FIELDS]
+        if self.library == "msgspec":
+            decoder = self.__row_decoders.get(model)
+            if decoder is None:
+                row_type = self.__module.defstruct(model.__name__ + "Row", [(key, object, None) for key in keys])
+                decoder = self.__module.json.Decoder(list[row_type])
+                self.__row_decoders[model] = decoder
+            try:
+                return decoder.decode(data), getattr
+            except self.__module.ValidationError:
+                # Valid json but not a list of rows (an error document of psacc) :
+                # decoded whole so that the error tells what psacc returned
+                return self.decode(data), dict.get
+            except self.__module.MsgspecError as e:
+                raise PsaccDataError("invalid json from psacc : " + str(e))
+        if self.library == "orjson":
+            return self.__module.loads(data), dict.get
+        keys = set(keys)
+        rows = json.loads(data, object_pairs_hook=lambda pairs: {key: value for key, value in pairs if key in keys})
+        if not isinstance(rows, list):
+            # The projection also applies to a top level object (an error document of psacc) :
+            # decoded again whole so that the error tells what psacc returned
+            rows = json.loads(data)
+        return rows, dict.get
+
+    def print(self, string="", st=None, end=None):
+        st = "[" + st + "] " if st else ""
+        if end is None:
+            print(st + string)
+        else:
+            print(st + string + " ", end="", flush="True")
+
+
+################################################################################
+# State Class to persist data between two executions of the script
+################################################################################
+class StateStore:
+    def __init__(self, state_folder=None, super_print=None, debug=False, filename="psacc-domoticz.state.json"):
+        self.__debug = debug
+
+        # Supersede local print function if provided as an argument
+        self.print = super_print if super_print else self.print
+
+        state_folder = (
+            os.path.dirname(os.path.realpath(__file__))
+            if state_folder is None
+            else str(state_folder).rstrip(os.path.sep)
+        )
+        self.state_file = state_folder + os.path.sep + filename
+        self.__data = {}
+
+        if os.path.exists(self.state_file):
+            try:
+                with open(self.state_file) as state_file:
+                    self.__data = json.load(state_file)
+            except Exception as e:
+                # A corrupted state only costs a full recomputation
+                self.print('"%s" unreadable state file, starting from scratch : %s' % (self.state_file, e), st="WW")
+                self.__data = {}
+
+    # Return the (mutable) dict of a section of the state
+    def section(self, name):
+        return self.__data.setdefault(name, {})
+
+    def save(self):
+        # Write in a temporary file first so that an interrupted run never leaves a truncated state
+        tmp_file = self.state_file + ".tmp"
+        with open(tmp_file, "w") as state_file:
+            json.dump(self.__data, state_file)
+        os.replace(tmp_file, self.state_file)
+        if self.__debug:
+            self.print("state saved to " + self.state_file, st="ok")
+
+    def print(self, string="", st=None, end=None):
+        st = "[" + st + "] " if st else ""
+        if end is None:
+            print(st + string)
+        else:
+            print(st + string + " ", end="", flush="True")
+
 ################################################################################
 # Configuration Class to parse and load config.json
 ################################################################################
@@ -154,6 +1312,72 @@ class Configuration:
             print(st + string + " ", end="", flush="True")
 
 
+################################################################################
+# Reader of the local SQLite database of psacc (co-located installations)
+################################################################################
+class PSACCDatabase:
+    # psacc keeps the charge sessions in the "battery" table of its database,
+    # the trips are not stored (psacc computes them from the positions at each
+    # request) and still come from /vehicles/trips.
+    # The database is opened read-only and only the sessions started since the
+    # marker of the charge accounting (included, it may still be in progress)
+    # are read as ChargeSession, like the sessions of /vehicles/chargings.
+    def __init__(self, database_file, vin, super_print=None, debug=False):
+        self.__debug = debug
+
+        # Supersede local print function if provided as an argument
+        self.print = super_print if super_print else self.print
+
+        self.database_file = database_file
+        self.vin = vin
+
+    # sqlite datetime ("2025-01-31 22:05:00+00:00", UTC when naive) -> timestamp
+    @staticmethod
+    def timestamp(value):
+        if value is None:
+            return None
+        date = datetime.fromisoformat(str(value))
+        if date.tzinfo is None:
+            date = date.replace(tzinfo=timezone.utc)
+        return date.timestamp()
+
+    def get_vehiclechargesessions(self, since=None):
+        import sqlite3
+
+        start = time.perf_counter()
+        connection = sqlite3.connect("file:" + self.database_file + "?mode=ro", uri=True)
+        try:
+            connection.row_factory = sqlite3.Row
+            query = "SELECT * FROM battery WHERE VIN = ?"
+            params = [self.vin]
+            if since is not None:
+                # day of the marker : the text comparison does not depend on the time format of the rows
+                query = query + " AND start_at >= ?"
+                params.append(datetime.fromtimestamp(since, timezone.utc).strftime("%Y-%m-%d"))
+            rows = connection.execute(query + " ORDER BY start_at", params).fetchall()
+        finally:
+            connection.close()
+
+        sessions = ChargeSessions()
+        for row in rows:
+            sessions.append(ChargeSession(
+                self.timestamp(row["start_at"]),
+                self.timestamp(row["stop_at"] if "stop_at" in row.keys() else None),
+                float(row["kw"] or 0.0),
+            ))
+        profiler.add("sqlite battery", time.perf_counter() - start, kind="sqlite")
+        if self.__debug:
+            self.print("charge sessions read from " + self.database_file + " : " + str(len(sessions)), st="ok")
+        return sessions
+
+    def print(self, string="", st=None, end=None):
+        st = "[" + st + "] " if st else ""
+        if end is None:
+            print(st + string)
+        else:
+            print(st + string + " ", end="", flush="True")
+
+
 ################################################################################
 # Object that retrieve the historical data from psacc server
 ################################################################################
@@ -185,8 +1409,14 @@ class PSACCCrawler:
             "domoticz_login": None,
             "domoticz_password": None,
             "timeout": "30",
+            # Optional config values
+            "psacc_database": "",
+            "json_decoder": "auto",
         }
 
+        # Wakeups shared by the runs and the vehicles
+        self.wakeups = WakeupManager(config_dict, config_dict.get("download_folder"), super_print=self.print, debug=debug)
+
         # Intialisation des variables contenant les données de psacc
         self.vehicleinfo = None
         self.vehicletrips = None
@@ -203,6 +1433,8 @@ class PSACCCrawler:
             if self.__debug:
                 self.print(st="ok")
 
+        self.decoder = JsonDecoder(self.configuration["json_decoder"], super_print=self.print, debug=debug)
+
 
     # Load configuration items
     def _load_configuration_items(self, config_dict):
@@ -233,101 +1465,918 @@ class PSACCCrawler:
                     self.print(st="OK")
 
 
+    # GET a psacc url, the time and the size of the response are recorded in the profiler.
+    # The response is compressed if the server (or a reverse proxy in front of
+    # psacc) supports it, and decompressed while it is received
+    def _get(self, path, params=None):
+        myurl = self.configuration["psacc_server"] + path
+        if params:
+            myurl = myurl + "?" + params
+        name = "http psacc " + path.replace(str(self.configuration["VIN"]), "<VIN>")
+        start = time.perf_counter()
+        try:
+            timeout = run_deadline.timeout(self.configuration["timeout"])
+            req = http_client().request(
+                "GET", myurl, headers=PSACC_HEADERS, timeout=timeout, retries=run_deadline.retries(timeout),
+                preload_content=False,
+            )
+            data, received = read_streamed(req)
+        except urllib3.exceptions.HTTPError as e:
+            # HANDLE CONNECTIVITY ERROR
+            profiler.add(name, time.perf_counter() - start, kind="http", error=True)
+            run_deadline.check()
+            raise RuntimeError("url=" + myurl + " : " + str(e))
+        profiler.add(name, time.perf_counter() - start, received, kind="http", error=req.status != 200)
+        profiler.count("psacc bytes decompressed", len(data))
+        if self.__debug:
+            print(u'  '.join((u'GET-> ',myurl,' : ',str(req.status))).encode('utf-8'))
+        return BufferedResponse(req.status, data)
+
+    # Decode the json of a psacc response, the time is recorded in the profiler
+    def _decode(self, req, path):
+        with profiler.phase("json decode " + path):
+            return self.decoder.decode(req.data)
+
+    # Decode the rows of a psacc response keeping only the fields of "model",
+    # return them with the function reading their fields
+    def _decode_rows(self, req, path, model):
+        with profiler.phase("json decode " + path):
+            return self.decoder.decode_rows(req.data, model)
+
     def get_vehicleinfo(self, fromcache=True):
         if self.__debug:
             self.print("get vehicle info data from psacc", end="")
             self.print(st="")
         ###### get json file from psacc server #####
-        myurl=self.configuration["psacc_server"]+"/get_vehicleinfo/"+self.configuration["VIN"]
+        path = "/get_vehicleinfo/"+self.configuration["VIN"]
         if fromcache==True:
-            req = requests.get(myurl,params="from_cache=1") #get from cache to avoid too much requests
+            req = self._get(path, params="from_cache=1") #get from cache to avoid too much requests
+        else:
+            req = self._get(path)
+
+        if req.status==200 : # Réponse HTTP 200 : OK
+            vehicleinfo = self._decode(req, "/get_vehicleinfo")
+            if self.__debug:
+                self.print("json : %s", end="", args=(debug_dump(vehicleinfo),))
+                self.print(st="ok")
+            with profiler.phase("parse /get_vehicleinfo"):
+                self.vehicleinfo = VehicleInfo.parse(vehicleinfo)
+            return self.vehicleinfo
+            
+        else:
+            self.print(st="EE")
+        
+        return False
+      
+
+    def get_vehicletrips(self):
+        if self.__debug:
+            self.print("get vehicle trips data from psacc", end="")
+            self.print(st="")
+        req = self._get("/vehicles/trips")
+
+        if req.status==200 : # Réponse HTTP 200 : OK
+            vehicletrips, get = self._decode_rows(req, "/vehicles/trips", Trip)
+            if self.__debug:
+                self.print("json : %s", end="", args=(debug_dump(vehicletrips),))
+                self.print(st="ok")
+            with profiler.phase("parse /vehicles/trips"):
+                self.vehicletrips = Trips.parse(vehicletrips, "trip", get)
+            return self.vehicletrips
+            
         else:
-            req = requests.get(myurl)
+            self.print(st="EE")
+        
+        return False
+        
+    # since : start (timestamp) of the last session already accounted, only the
+    # sessions started since are read when they come from the psacc database
+    def get_vehiclechargesessions(self, since=None):
+        if self.configuration["psacc_database"]:
+            database = PSACCDatabase(
+                self.configuration["psacc_database"], self.configuration["VIN"], super_print=self.print, debug=self.__debug
+            )
+            self.vehiclechargesessions = database.get_vehiclechargesessions(since)
+            return self.vehiclechargesessions
+
+        if self.__debug:
+            self.print("get vehicle charge sessions data from psacc", end="")
+            self.print(st="")
+        req = self._get("/vehicles/chargings")
+
+        if req.status==200 : # Réponse HTTP 200 : OK
+            vehiclechargesessions, get = self._decode_rows(req, "/vehicles/chargings", ChargeSession)
+            if self.__debug:
+                self.print("json : %s", end="", args=(debug_dump(vehiclechargesessions),))
+                self.print(st="ok")
+            with profiler.phase("parse /vehicles/chargings"):
+                self.vehiclechargesessions = ChargeSessions.parse(vehiclechargesessions, "charge session", get)
+            return self.vehiclechargesessions
             
+        else:
+            self.print(st="EE")
+        
+        return False
+
+
+    # reason : why the wakeup is requested, logged with the grant or the refusal
+    # Return the date of the wakeup the vehicle data can be read after (90
+    # seconds later) : this one, or the one in flight it is merged with. None
+    # if there is no wakeup to wait for
+    def force_vehicle_update(self, reason=""):
+        vin = self.configuration["VIN"]
+        granted, since = self.wakeups.request(vin, reason)
+        if not granted:
+            return since
+        self.print("Force vehicule update", end="")
+
+        accepted = False
+        try:
+            req = self._get("/wakeup/"+vin)
+
+            if req.status==200 : # Réponse HTTP 200 : OK
+                wakeup = self._decode(req, "/wakeup")
+                if self.__debug:
+                    self.print("json : %s", end="", args=(debug_dump(wakeup),))
+                    self.print(st="")
+                accepted = wakeup==True
+        finally:
+            # the cooldown only starts with a wakeup psacc accepted
+            if accepted:
+                self.wakeups.confirm(vin)
+            else:
+                self.wakeups.release(vin)
+        if accepted:
+            return since
+
+        self.print(st="EE")
+        return None
+
+
+################################################################################
+# Prometheus metrics of the runs health and of the vehicle state
+################################################################################
+class MetricsExporter:
+    # Histograms and counters must be cumulative for prometheus while each cron
+    # run is a new process : they are persisted in psacc-domoticz.metrics.json
+    # and updated with the measures of the run recorded by the profiler.
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+    def __init__(self, config_dict, state_folder=None, super_print=None, debug=False):
+        self.__debug = debug
+
+        # Supersede local print function if provided as an argument
+        self.print = super_print if super_print else self.print
+
+        self.textfile = config_dict.get("prometheus_textfile", "")
+        self.port = config_dict.get("prometheus_port", "")
+        self.success = False
+        self.__lock = threading.Lock()
+        self.__store = None
+        self.metrics = {}
+        if self.enabled():
+            self.__store = StateStore(state_folder, super_print=super_print, debug=debug, filename="psacc-domoticz.metrics.json")
+            self.metrics = self.__store.section("metrics")
+
+    def enabled(self):
+        return bool(self.textfile or self.port)
+
+    def __labels(self, labels):
+        return ",".join(
+            '%s="%s"' % (key, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+            for key, value in sorted(labels.items())
+        )
+
+    def __metric(self, name, kind, help_text):
+        return self.metrics.setdefault(name, {"type": kind, "help": help_text, "values": {}})
+
+    def observe(self, name, help_text, labels, value):
+        values = self.__metric(name, "histogram", help_text)["values"]
+        histogram = values.setdefault(self.__labels(labels), {"buckets": [0] * len(self.BUCKETS), "sum": 0.0, "count": 0})
+        for index, bucket in enumerate(self.BUCKETS):
+            if value <= bucket:
+                histogram["buckets"][index] = histogram["buckets"][index] + 1
+        histogram["sum"] = histogram["sum"] + value
+        histogram["count"] = histogram["count"] + 1
+
+    def inc(self, name, help_text, labels, value=1):
+        values = self.__metric(name, "counter", help_text)["values"]
+        key = self.__labels(labels)
+        values[key] = values.get(key, 0) + value
+
+    def set(self, name, help_text, labels, value):
+        self.__metric(name, "gauge", help_text)["values"][self.__labels(labels)] = value
+
+    # Subscriber of SnapshotDiff : the gauges of the changed sections of vehicleinfo
+    def vehicle_changed(self, section, old, new):
+        if not self.enabled() or new is None:
+            return
+        with self.__lock:
+            if section == "odometer":
+                self.set("psacc_vehicle_odometer_km", "Odometer of the vehicle", {}, new["mileage"])
+            elif section.startswith("energy "):
+                labels = {"type": new["type"]}
+                self.set("psacc_vehicle_energy_level_percent", "Battery or fuel level", labels, float(new["level"]))
+                self.set("psacc_vehicle_autonomy_km", "Autonomy with the battery or the fuel", labels, float(new["autonomy"]))
+                self.set("psacc_vehicle_energy_updated_timestamp_seconds", "Date of the last update of the energy data by the vehicle",
+                    labels, new["updated_at"])
+            elif section == "charging Electric":
+                self.set("psacc_vehicle_charging", "1 while the vehicle is charging", {},
+                    1 if str(new["status"]) == "InProgress" else 0)
+            elif section == "environment":
+                self.set("psacc_vehicle_air_temperature_celsius", "Air temperature measured by the vehicle", {},
+                    new["air_temperature"])
+
+    # Add the measures of the run recorded by the profiler
+    def collect_run(self, run_profiler, duration):
+        with self.__lock:
+            for name, entry in run_profiler.entries.items():
+                if entry["kind"] == "phase":
+                    self.observe("psacc_domoticz_phase_duration_seconds", "Duration of the phases of the runs",
+                        {"phase": name}, entry["seconds"])
+            for name, seconds, error in run_profiler.calls:
+                if not name.startswith("http "):
+                    continue
+                target, _, endpoint = name[len("http "):].partition(" ")
+                labels = {"target": target, "endpoint": endpoint}
+                self.observe("psacc_domoticz_http_request_duration_seconds", "Latency of the http calls", labels, seconds)
+                self.inc("psacc_domoticz_http_requests_total", "Number of http calls", labels)
+                if error:
+                    self.inc("psacc_domoticz_http_errors_total", "Number of failed http calls", labels)
+            for result in ("pushed", "skipped"):
+                self.inc("psacc_domoticz_device_updates_total", "Number of domoticz devices updates",
+                    {"result": result}, run_profiler.counters.get("device updates " + result, 0))
+            self.observe("psacc_domoticz_run_duration_seconds", "Duration of the runs", {}, duration)
+            self.inc("psacc_domoticz_runs_total", "Number of runs", {"result": "success" if self.success else "error"})
+            self.set("psacc_domoticz_last_run_timestamp_seconds", "Date of the last run", {}, time.time())
+            self.set("psacc_domoticz_last_run_success", "1 if the last run ended on success", {}, 1 if self.success else 0)
+
+    def render(self):
+        lines = []
+        with self.__lock:
+            for name, metric in sorted(self.metrics.items()):
+                lines.append("# HELP " + name + " " + metric["help"])
+                lines.append("# TYPE " + name + " " + metric["type"])
+                for labels, value in sorted(metric["values"].items()):
+                    if metric["type"] != "histogram":
+                        lines.append(name + ("{" + labels + "}" if labels else "") + " " + repr(value))
+                        continue
+                    separator = "," if labels else ""
+                    for bucket, count in zip(self.BUCKETS, value["buckets"]):
+                        lines.append(name + '_bucket{' + labels + separator + 'le="' + str(bucket) + '"} ' + str(count))
+                    lines.append(name + '_bucket{' + labels + separator + 'le="+Inf"} ' + str(value["count"]))
+                    lines.append(name + "_sum" + ("{" + labels + "}" if labels else "") + " " + repr(value["sum"]))
+                    lines.append(name + "_count" + ("{" + labels + "}" if labels else "") + " " + str(value["count"]))
+        return "\n".join(lines) + "\n"
+
+    # Write the metrics for the node exporter textfile collector, and persist them for the next run
+    def write_textfile(self):
+        if self.__store is not None:
+            self.__store.save()
+        if self.textfile:
+            # node exporter may read the file at any time : write it atomically
+            tmp_file = self.textfile + ".tmp"
+            with open(tmp_file, "w") as textfile:
+                textfile.write(self.render())
+            os.replace(tmp_file, self.textfile)
+
+    # Serve the metrics on http://<host>:<prometheus_port>/metrics, for the long running modes
+    def serve(self):
+        import http.server
+        exporter = self
+
+        class MetricsHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = exporter.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer(("", int(self.port)), MetricsHandler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        return server
+
+    def print(self, string="", st=None, end=None):
+        st = "[" + st + "] " if st else ""
+        if end is None:
+            print(st + string)
+        else:
+            print(st + string + " ", end="", flush="True")
+
+
+################################################################################
+# Time-of-use tariff to price the energy of the charge sessions
+################################################################################
+class Tariff:
+    # The bands of the config ({"start": "22:00", "end": "06:00", "price": 0.15,
+    # "days": [0, 1, 2, 3, 4]} with days 0=monday, all days if omitted) are
+    # flattened once into a sorted index of the boundaries over a week. Finding
+    # the price at a given time is then a bisect in this index.
+    WEEK = 7 * 86400
+
+    def __init__(self, bands, default_price=0.0, efficiency=1.0):
+        self.efficiency = efficiency if efficiency > 0 else 1.0
+        # Identifies the configuration the costs were computed with
+        self.fingerprint = json.dumps(
+            {"bands": bands, "default_price": default_price, "efficiency": self.efficiency}, sort_keys=True
+        )
+        intervals = []
+        for band in bands:
+            start = self.__seconds(band["start"])
+            end = self.__seconds(band["end"])
+            for day in band.get("days", range(7)):
+                day_start = int(day) * 86400 + start
+                day_end = int(day) * 86400 + end
+                if end <= start:
+                    # band over midnight
+                    day_end = day_end + 86400
+                if day_end > self.WEEK:
+                    intervals.append((day_start, self.WEEK, float(band["price"])))
+                    intervals.append((0, day_end - self.WEEK, float(band["price"])))
+                else:
+                    intervals.append((day_start, day_end, float(band["price"])))
+
+        # Elementary segments between all the boundaries, the last band of the config wins on overlaps
+        self.boundaries = sorted(set([0, self.WEEK] + [i[0] for i in intervals] + [i[1] for i in intervals]))
+        self.prices = []
+        for index, boundary in enumerate(self.boundaries[:-1]):
+            price = default_price
+            for interval_start, interval_end, interval_price in intervals:
+                if interval_start <= boundary < interval_end:
+                    price = interval_price
+            self.prices.append(price)
+
+    def __seconds(self, hour_minute):
+        hours, minutes = str(hour_minute).split(":")
+        return int(hours) * 3600 + int(minutes) * 60
+
+    # Position in the week of a timestamp, in local time
+    def __week_position(self, timestamp):
+        local = datetime.fromtimestamp(timestamp)
+        return local.weekday() * 86400 + local.hour * 3600 + local.minute * 60 + local.second + local.microsecond / 1000000
+
+    def price_at(self, timestamp):
+        position = self.__week_position(timestamp)
+        return self.prices[bisect.bisect_right(self.boundaries, position) - 1]
+
+    # Cost of an energy drawn evenly between two timestamps
+    def cost(self, start, stop, energy):
+        if stop <= start:
+            return energy / self.efficiency * self.price_at(start)
+
+        weighted_price = 0.0
+        current = start
+        while current < stop:
+            position = self.__week_position(current)
+            index = bisect.bisect_right(self.boundaries, position) - 1
+            segment_end = min(stop, current + self.boundaries[index + 1] - position)
+            weighted_price = weighted_price + self.prices[index] * (segment_end - current)
+            current = segment_end
+        return energy / self.efficiency * weighted_price / (stop - start)
+
+
+################################################################################
+# Incremental accounting of the energy of the charge sessions
+################################################################################
+class ChargeAccounting:
+    # The running totals and a marker on the last session seen are persisted in
+    # the state, so each run only processes the sessions started since the
+    # marker. The marked session is processed again as long as it may change :
+    # while it is in progress (no stop_at) it is an open interval whose energy
+    # grows, so only the difference with what was already counted is added.
+    # The totals are recomputed from the whole history when the tariff is
+    # enabled, disabled or changed, so that the total cost always covers the
+    # same sessions as the total energy, at the same prices.
+    def __init__(self, state, tariff=None, super_print=None, debug=False):
+        self.__debug = debug
+
+        # Supersede local print function if provided as an argument
+        self.print = super_print if super_print else self.print
+
+        self.state = state.section("charge_accounting")
+        self.tariff = tariff
+        self.fingerprint = tariff.fingerprint if tariff else None
+        self.__pending = None
+
+    # True if the totals of the state were computed with another tariff
+    def tariff_changed(self):
+        return self.state.get("last_start") is not None and self.state.get("tariff") != self.fingerprint
+
+    # Start of the sessions to process : the marker, or None when the whole history has to be processed again
+    def since(self):
+        return None if self.tariff_changed() else self.state.get("last_start")
+
+    # Return the totals and the cost of the last session, and whether they changed since last commit
+    def process(self, chargesessions):
+        total_kw = float(self.state.get("total_kw", 0.0))
+        total_cost = float(self.state.get("total_cost", 0.0))
+        last_start = self.state.get("last_start")
+        last_kw = float(self.state.get("last_kw", 0.0))
+        last_cost = float(self.state.get("last_cost", 0.0))
+        recomputed = self.tariff_changed()
+        if recomputed:
+            self.print("charging tariff changed, the charge totals are recomputed from the whole history", st="WW")
+            total_kw, total_cost, last_start, last_kw, last_cost = 0.0, 0.0, None, 0.0, 0.0
+
+        # the marked session is processed again
+        new_sessions = chargesessions.since(last_start, inclusive=True)
+
+        open_session = False
+        for session in new_sessions:
+            start = session.start
+            kw = session.kw
+            cost = 0.0
+            if self.tariff:
+                # An open session is priced up to now
+                stop = session.stop if session.stop is not None else time.time()
+                cost = self.tariff.cost(start, stop, kw)
+            if start == last_start:
+                total_kw = total_kw + kw - last_kw
+                total_cost = total_cost + cost - last_cost
+            else:
+                total_kw = total_kw + kw
+                total_cost = total_cost + cost
+            last_start = start
+            last_kw = kw
+            last_cost = cost
+            open_session = session.stop is None
+
+        total_kw = round(total_kw, 3)
+        total_cost = round(total_cost, 4)
+        # after a recomputation the new tariff and marker must be saved, even with the same totals
+        changed = (recomputed or total_kw != self.state.get("total_kw") or
+            (self.tariff is not None and total_cost != self.state.get("total_cost")))
+        if self.__debug:
+            self.print("charge sessions processed : " + str(len(new_sessions)) + " - total " + str(total_kw) + " kwh", st="ok")
+
+        self.__pending = {
+            "total_kw": total_kw,
+            "total_cost": total_cost,
+            "last_start": last_start,
+            "last_kw": last_kw,
+            "last_cost": round(last_cost, 4),
+            "open": open_session,
+            "tariff": self.fingerprint,
+        }
+        return self.__pending, changed
+
+    # Persist the result of the last process() once it has been pushed to domoticz
+    def commit(self):
+        if self.__pending:
+            self.state.update(self.__pending)
+            self.__pending = None
+
+    def print(self, string="", st=None, end=None):
+        st = "[" + st + "] " if st else ""
+        if end is None:
+            print(st + string)
+        else:
+            print(st + string + " ", end="", flush="True")
+
+
+################################################################################
+# Ring buffer of trips keeping the running sums of the trips it contains
+################################################################################
+class RollingWindow:
+    # Each entry is [start timestamp, distance, electric energy kwh, fuel l].
+    # Adding or evicting a trip only updates the sums, the window is never rescanned.
+    def __init__(self, entries=(), max_trips=None, max_age=None):
+        self.max_trips = max_trips
+        self.max_age = max_age
+        self.entries = deque()
+        self.distance = 0.0
+        self.energy = 0.0
+        self.fuel = 0.0
+        for entry in entries:
+            self.push(entry)
+
+    def push(self, entry):
+        self.entries.append(entry)
+        self.distance = self.distance + entry[1]
+        self.energy = self.energy + entry[2]
+        self.fuel = self.fuel + entry[3]
+        if self.max_trips and len(self.entries) > self.max_trips:
+            self.pop()
+
+    def pop(self):
+        entry = self.entries.popleft()
+        self.distance = self.distance - entry[1]
+        self.energy = self.energy - entry[2]
+        self.fuel = self.fuel - entry[3]
+
+    # Evict the trips older than max_age seconds
+    def expire(self, now):
+        if self.max_age:
+            while self.entries and self.entries[0][0] < now - self.max_age:
+                self.pop()
+
+    # Return (kwh/100km, l/100km) over the window, None if no distance
+    def consumption(self):
+        if self.distance <= 0:
+            return None
+        return (
+            round(self.energy / self.distance * 100, 2),
+            round(self.fuel / self.distance * 100, 2),
+        )
+
+
+################################################################################
+# Rolling consumption statistics over the last N trips and the last N days
+################################################################################
+class RollingConsumption:
+    def __init__(self, state, trips_window=10, days_window=30, super_print=None, debug=False):
+        self.__debug = debug
+
+        # Supersede local print function if provided as an argument
+        self.print = super_print if super_print else self.print
+
+        self.state = state.section("rolling_consumption")
+
+        # Windows size changed since last run : rebuild them from the whole trips list
+        if (self.state.get("trips_window") != trips_window or
+            self.state.get("days_window") != days_window):
+            self.state.clear()
+        self.state["trips_window"] = trips_window
+        self.state["days_window"] = days_window
+
+        # The sums are rebuilt from the persisted entries (bounded by the windows
+        # size) to avoid accumulating floating point drift run after run
+        self.last_trips = RollingWindow(self.state.get("last_trips", []), max_trips=trips_window)
+        self.last_days = RollingWindow(self.state.get("last_days", []), max_age=days_window * 86400)
+
+    def process(self, trips):
+        last_start = self.state.get("last_start")
+
+        # the trips started after the last one already seen
+        new_trips = trips.since(last_start)
+
+        for trip in new_trips:
+            entry = [
+                trip.start,
+                trip.distance,
+                trip.consumption_km * trip.distance / 100,
+                trip.consumption_fuel_km * trip.distance / 100,
+            ]
+            self.last_trips.push(entry)
+            self.last_days.push(entry)
+            last_start = trip.start
+        self.last_days.expire(time.time())
+
         if self.__debug:
-            print(u'  '.join((u'GET-> ',myurl,' : ',str(req.status_code))).encode('utf-8'))
+            self.print("rolling consumption trips processed : " + str(len(new_trips)), st="ok")
+
+        self.state["last_start"] = last_start
+        self.state["last_trips"] = list(self.last_trips.entries)
+        self.state["last_days"] = list(self.last_days.entries)
+        return self.last_trips.consumption(), self.last_days.consumption()
+
+    def print(self, string="", st=None, end=None):
+        st = "[" + st + "] " if st else ""
+        if end is None:
+            print(st + string)
+        else:
+            print(st + string + " ", end="", flush="True")
+
+
+################################################################################
+# Mergeable quantile sketch (merging t-digest) of bounded size
+################################################################################
+class TDigest:
+    # Values are summarized by sorted centroids [mean, weight]. The k1 scale
+    # function keeps the centroids small near the tails and large around the
+    # median, the number of centroids stays around compression whatever the
+    # number of values added.
+    def __init__(self, compression=100, centroids=(), minimum=None, maximum=None):
+        self.compression = compression
+        self.centroids = [list(centroid) for centroid in centroids]
+        self.minimum = minimum
+        self.maximum = maximum
+        self.__buffer = []
+
+    @property
+    def count(self):
+        return sum(centroid[1] for centroid in self.centroids) + sum(point[1] for point in self.__buffer)
+
+    def add(self, value, weight=1.0):
+        self.__buffer.append([value, weight])
+        self.minimum = value if self.minimum is None else min(self.minimum, value)
+        self.maximum = value if self.maximum is None else max(self.maximum, value)
+        if len(self.__buffer) > self.compression * 5:
+            self.compress()
+
+    def merge(self, other):
+        other.compress()
+        self.__buffer.extend(list(centroid) for centroid in other.centroids)
+        if other.minimum is not None:
+            self.minimum = other.minimum if self.minimum is None else min(self.minimum, other.minimum)
+            self.maximum = other.maximum if self.maximum is None else max(self.maximum, other.maximum)
+        self.compress()
+
+    def __k(self, q):
+        return self.compression / (2 * math.pi) * math.asin(2 * min(max(q, 0.0), 1.0) - 1)
+
+    def compress(self):
+        if not self.__buffer:
+            return
+        points = sorted(self.centroids + self.__buffer)
+        self.__buffer = []
+        total = sum(point[1] for point in points)
+
+        merged = []
+        weight_before = 0.0
+        current = list(points[0])
+        k_left = self.__k(0.0)
+        for mean, weight in points[1:]:
+            if self.__k((weight_before + current[1] + weight) / total) - k_left <= 1:
+                current[0] = current[0] + (mean - current[0]) * weight / (current[1] + weight)
+                current[1] = current[1] + weight
+            else:
+                merged.append(current)
+                weight_before = weight_before + current[1]
+                k_left = self.__k(weight_before / total)
+                current = [mean, weight]
+        merged.append(current)
+        self.centroids = merged
+
+    def quantile(self, q):
+        self.compress()
+        if not self.centroids:
+            return None
+        if len(self.centroids) == 1:
+            return self.centroids[0][0]
+
+        # Interpolate between the centers of the two centroids around the target
+        target = q * sum(centroid[1] for centroid in self.centroids)
+        previous_mean, previous_center = self.minimum, 0.0
+        cumulative = 0.0
+        for mean, weight in self.centroids:
+            center = cumulative + weight / 2
+            if target < center:
+                if center == previous_center:
+                    return mean
+                return previous_mean + (mean - previous_mean) * (target - previous_center) / (center - previous_center)
+            cumulative = cumulative + weight
+            previous_mean, previous_center = mean, center
+        if cumulative == previous_center:
+            return self.maximum
+        return previous_mean + (self.maximum - previous_mean) * (target - previous_center) / (cumulative - previous_center)
+
+    def to_dict(self):
+        self.compress()
+        return {
+            "compression": self.compression,
+            "centroids": [[round(mean, 4), weight] for mean, weight in self.centroids],
+            "minimum": self.minimum,
+            "maximum": self.maximum,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            compression=data.get("compression", 100),
+            centroids=data.get("centroids", []),
+            minimum=data.get("minimum"),
+            maximum=data.get("maximum"),
+        )
+
+
+################################################################################
+# Trip distance and efficiency distributions over the whole vehicle history
+################################################################################
+class TripDistributions:
+    def __init__(self, state, super_print=None, debug=False):
+        self.__debug = debug
+
+        # Supersede local print function if provided as an argument
+        self.print = super_print if super_print else self.print
 
-        if req.status_code==200 : # Réponse HTTP 200 : OK
-            self.vehicleinfo = req.json()
-            if self.__debug:
-                self.print("json : " + str(self.vehicleinfo), end="")
-                self.print(st="ok")
-            return self.vehicleinfo
-            
-        else:
-            self.print(st="EE")
-        
-        return False
-      
+        self.state = state.section("trip_distributions")
+        self.distance = TDigest.from_dict(self.state.get("distance", {}))
+        self.efficiency = TDigest.from_dict(self.state.get("efficiency", {}))
+
+    def process(self, trips):
+        last_start = self.state.get("last_start")
+
+        # Only the trips started after the last one already in the sketches are added
+        new_trips = trips.since(last_start)
+
+        for trip in new_trips:
+            if trip.distance > 0:
+                self.distance.add(trip.distance)
+                self.efficiency.add(trip.consumption_km)
+            last_start = trip.start
 
-    def get_vehicletrips(self):
-        if self.__debug:
-            self.print("get vehicle trips data from psacc", end="")
-            self.print(st="")
-        myurl = self.configuration["psacc_server"]+"/vehicles/trips"
-        req = requests.get(myurl) 
         if self.__debug:
-            print(u'  '.join((u'GET-> ',myurl,' : ',str(req.status_code))).encode('utf-8'))
+            self.print("trip distributions trips processed : " + str(len(new_trips))
+                + " - centroids " + str(len(self.distance.centroids)), st="ok")
+
+        self.state["last_start"] = last_start
+        self.state["distance"] = self.distance.to_dict()
+        self.state["efficiency"] = self.efficiency.to_dict()
+
+        if self.distance.count == 0:
+            return None, None
+        return (
+            (round(self.distance.quantile(0.5), 1), round(self.distance.quantile(0.9), 1)),
+            (round(self.efficiency.quantile(0.5), 1), round(self.efficiency.quantile(0.9), 1)),
+        )
 
-        if req.status_code==200 : # Réponse HTTP 200 : OK
-            self.vehicletrips = req.json()
-            if self.__debug:
-                self.print("json : " + str(req.json()), end="")
-                self.print(st="ok")
-            return self.vehicletrips
-            
+    def print(self, string="", st=None, end=None):
+        st = "[" + st + "] " if st else ""
+        if end is None:
+            print(st + string)
         else:
-            self.print(st="EE")
-        
-        return False
-        
-    def get_vehiclechargesessions(self):
-        if self.__debug:
-            self.print("get vehicle charge sessions data from psacc", end="")
-            self.print(st="")
-        myurl = self.configuration["psacc_server"]+"/vehicles/chargings"
-        req = requests.get(myurl) 
-        if self.__debug:
-            print(u'  '.join((u'GET-> ',myurl,' : ',str(req.status_code))).encode('utf-8'))
+            print(st + string + " ", end="", flush="True")
+
+
+################################################################################
+# Charge completion estimated time from the battery level samples of a session
+################################################################################
+class ChargeEta:
+    # The charge rate is the slope of a least-squares fit of the level over the
+    # time. The fit only keeps the sums of the samples of a sliding window, so
+    # adding (or evicting) a sample costs O(1). Times are relative to the first
+    # sample of the session to keep the sums precise. The samples of a session
+    # are dropped when another one starts, even without a run in between seeing
+    # the vehicle not charging (unplugged and plugged again between two runs) :
+    # the level dropped, or psacc reports another start for the open session.
+    def __init__(self, state, target_level=100, max_samples=12, super_print=None, debug=False):
+        self.__debug = debug
 
-        if req.status_code==200 : # Réponse HTTP 200 : OK
-            self.vehiclechargesessions = req.json()
+        # Supersede local print function if provided as an argument
+        self.print = super_print if super_print else self.print
+
+        self.state = state.section("charge_eta")
+        self.target_level = target_level
+        self.max_samples = max_samples
+        self.samples = deque()
+        self.__n = 0
+        self.__sx = self.__sy = self.__sxx = self.__sxy = 0.0
+        self.origin = self.state.get("origin")
+        for sample in self.state.get("samples", [])[-max_samples:]:
+            self.__push(sample)
+
+    def __push(self, sample):
+        x, y = sample[0] - self.origin, sample[1]
+        self.samples.append(sample)
+        self.__n = self.__n + 1
+        self.__sx = self.__sx + x
+        self.__sy = self.__sy + y
+        self.__sxx = self.__sxx + x * x
+        self.__sxy = self.__sxy + x * y
+        if self.__n > self.max_samples:
+            x, y = self.samples[0][0] - self.origin, self.samples[0][1]
+            self.samples.popleft()
+            self.__n = self.__n - 1
+            self.__sx = self.__sx - x
+            self.__sy = self.__sy - y
+            self.__sxx = self.__sxx - x * x
+            self.__sxy = self.__sxy - x * y
+
+    # Add a (timestamp, level) sample and return the timestamp at which the target level will be reached.
+    # session : start of the charge session in progress, None if unknown
+    def add_sample(self, timestamp, level, session=None):
+        new_session = (session is not None and self.state.get("session") not in (None, session)) or (
+            self.samples and level < self.samples[-1][1]
+        )
+        if new_session:
             if self.__debug:
-                self.print("json : " + str(req.json()), end="")
-                self.print(st="ok")
-            return self.vehiclechargesessions
-            
+                self.print("new charge session, the charge rate samples are cleared", st="ok")
+            self.reset()
+        if session is not None:
+            self.state["session"] = session
+        if self.origin is None:
+            self.origin = timestamp
+        # psacc may return the same data several times when read from its cache
+        if not self.samples or self.samples[-1][0] != timestamp:
+            self.__push([timestamp, level])
+        self.state["origin"] = self.origin
+        self.state["samples"] = list(self.samples)
+
+        if level >= self.target_level:
+            return timestamp
+        denominator = self.__n * self.__sxx - self.__sx * self.__sx
+        if self.__n < 2 or denominator <= 0:
+            return None
+        slope = (self.__n * self.__sxy - self.__sx * self.__sy) / denominator
+        if slope <= 0:
+            return None
+        if self.__debug:
+            self.print("charge rate " + str(round(slope * 3600, 2)) + " %/h over " + str(self.__n) + " samples", st="ok")
+        return timestamp + (self.target_level - level) / slope
+
+    # End of the session, return True if there was a session to clear
+    def reset(self):
+        had_samples = bool(self.state.get("samples"))
+        self.state.clear()
+        self.samples.clear()
+        self.origin = None
+        self.__n = 0
+        self.__sx = self.__sy = self.__sxx = self.__sxy = 0.0
+        return had_samples
+
+    def print(self, string="", st=None, end=None):
+        st = "[" + st + "] " if st else ""
+        if end is None:
+            print(st + string)
         else:
-            self.print(st="EE")
-        
-        return False
+            print(st + string + " ", end="", flush="True")
 
 
-    def force_vehicle_update(self):
-        self.print("Force vehicule update", end="")
-        
-        myurl=self.configuration["psacc_server"]+"/wakeup/"+self.configuration["VIN"]
-        req = requests.get(myurl)
-        if self.__debug:
-            print(u'  '.join((u'GET-> ',myurl,' : ',str(req.status_code))).encode('utf-8'))
+################################################################################
+# Structural diff of the vehicle data between two fetches
+################################################################################
+class SnapshotDiff:
+    # vehicleinfo is split in sections (odometer, each energy entry and its
+    # charging state, environment) compared with the snapshot of the previous
+    # fetch kept in the state. The subscribers receive (section, old, new) for
+    # each changed section. A section unchanged for "snapshot_max_age" seconds
+    # is sent again, so that the domoticz devices never time out.
+    def __init__(self, state, max_age=1800, super_print=None, debug=False):
+        self.__debug = debug
 
-        if req.status_code==200 : # Réponse HTTP 200 : OK
-            if self.__debug:
-                self.print("json : " + str(req.json()), end="")
-                self.print(st="")
-            if req.json()==True:
-                return True
-                
+        # Supersede local print function if provided as an argument
+        self.print = super_print if super_print else self.print
 
-        self.print(st="EE")
-        return False
+        self.state = state.section("snapshot")
+        self.max_age = float(max_age)
+        self.subscribers = []
+        self.pending = None
+
+    # Sections of vehicleinfo (VehicleInfo), by name, as json values
+    @staticmethod
+    def sections(vehicleinfo):
+        sections = {}
+        if not vehicleinfo:
+            return sections
+        if vehicleinfo.mileage is not None:
+            sections["odometer"] = {
+                "mileage": vehicleinfo.mileage,
+                "updated_at": vehicleinfo.odometer_updated_at.timestamp() if vehicleinfo.odometer_updated_at else None,
+            }
+        for energy in vehicleinfo.energies:
+            sections["energy " + energy.type] = {
+                "type": energy.type,
+                "level": energy.level,
+                "autonomy": energy.autonomy,
+                "updated_at": energy.updated_at.timestamp(),
+            }
+            if energy.charging_status is not None:
+                sections["charging " + energy.type] = {"status": energy.charging_status}
+        if vehicleinfo.air_temperature is not None:
+            sections["environment"] = {"air_temperature": vehicleinfo.air_temperature}
+        return sections
+
+    # callback(section, old, new) is called for each changed section, or only
+    # for the ones given in "sections"
+    def subscribe(self, callback, sections=None):
+        self.subscribers.append((callback, set(sections) if sections else None))
+
+    # Return the names of the changed sections, the snapshot is kept by commit()
+    def diff(self, vehicleinfo, now=None):
+        now = time.time() if now is None else now
+        old_sections = self.state.get("sections", {})
+        sent = self.state.get("sent", {})
+        new_sections = self.sections(vehicleinfo)
+        changes = set()
+        for name, new in new_sections.items():
+            if old_sections.get(name) != new or now - sent.get(name, 0) >= self.max_age:
+                changes.add(name)
+        changes.update(name for name in old_sections if name not in new_sections)
+        if self.__debug:
+            self.print("vehicle data changed : " + (", ".join(sorted(changes)) or "nothing"), st="ok")
+        for name in sorted(changes):
+            for callback, sections in self.subscribers:
+                if sections is None or name in sections:
+                    callback(name, old_sections.get(name), new_sections.get(name))
+        self.pending = (new_sections, {name: now if name in changes else sent.get(name, 0) for name in new_sections})
+        return changes
+
+    # Keep the snapshot of the last diff, once the changes are processed
+    def commit(self):
+        if self.pending is not None:
+            self.state["sections"], self.state["sent"] = self.pending
+            self.pending = None
+
+    def print(self, string="", st=None, end=None):
+        st = "[" + st + "] " if st else ""
+        if end is None:
+            print(st + string)
+        else:
+            print(st + string + " ", end="", flush="True")
 
 
 ################################################################################
 # Object injects data into domoticz
 ################################################################################
 class DomoticzInjector:
-    def __init__(self, config_dict, super_print, debug=False):
+    def __init__(self, config_dict, super_print, debug=False, state=None):
         self.__debug = debug
 
         # Supersede local print function if provided as an argument
@@ -351,10 +2400,26 @@ class DomoticzInjector:
             "domoticz_password": "",
             "timeout": "30",
             "download_folder": os.path.dirname(os.path.realpath(__file__)) + os.path.sep,
+            # Optional config values
+            "domoticz_idx_rolling_trips_electric_consumption": "",
+            "domoticz_idx_rolling_trips_fuel_consumption": "",
+            "domoticz_idx_rolling_days_electric_consumption": "",
+            "domoticz_idx_rolling_days_fuel_consumption": "",
+            "rolling_trips_window": "10",
+            "rolling_days_window": "30",
+            "domoticz_idx_trip_distance_quantiles": "",
+            "domoticz_idx_trip_consumption_quantiles": "",
+            "domoticz_idx_charging_session_cost": "",
+            "domoticz_idx_charging_total_cost": "",
+            "tariff_bands": [],
+            "tariff_default_price": "0",
+            "tariff_charger_efficiency": "1",
+            "domoticz_idx_charging_eta": "",
+            "charging_eta_target_level": "100",
         }
-        
-        # Intialisation de la variable pour forcer la maj auprès de la voiture
-        self.force_update = False
+
+        # idx, value and latency of the last domoticz call, for the structured log
+        self.last_call = {}
         
         self.print("Start Loading Domoticz configuration")
         try:
@@ -367,10 +2432,53 @@ class DomoticzInjector:
             if self.__debug:
                 self.print(st="ok")
 
-        self.__http = urllib3.PoolManager(
-            retries=1, timeout=int(str(self.configuration["timeout"]))
-        )
-       
+        self.__http = http_client()
+        self.__timeout = int(str(self.configuration["timeout"]))
+
+        # Incremental charge accounting and statistics need a state persisted between runs
+        self.charge_accounting = None
+        self.rolling_consumption = None
+        self.trip_distributions = None
+        self.charge_eta = None
+        if state is not None:
+            tariff = None
+            if self.configuration["domoticz_idx_charging_session_cost"] or self.configuration["domoticz_idx_charging_total_cost"]:
+                tariff = Tariff(
+                    self.configuration["tariff_bands"],
+                    default_price=float(self.configuration["tariff_default_price"]),
+                    efficiency=float(self.configuration["tariff_charger_efficiency"]),
+                )
+            self.charge_accounting = ChargeAccounting(state, tariff=tariff, super_print=super_print, debug=debug)
+            self.rolling_consumption = RollingConsumption(
+                state,
+                trips_window=int(self.configuration["rolling_trips_window"]),
+                days_window=int(self.configuration["rolling_days_window"]),
+                super_print=super_print,
+                debug=debug,
+            )
+            self.trip_distributions = TripDistributions(state, super_print=super_print, debug=debug)
+            self.charge_eta = ChargeEta(
+                state,
+                target_level=int(self.configuration["charging_eta_target_level"]),
+                super_print=super_print,
+                debug=debug,
+            )
+
+    # True if one of the sections of vehicleinfo changed, always when the changes are unknown
+    def __changed(self, changes, *sections):
+        return changes is None or any(section in changes for section in sections)
+
+    # Update the value of a domoticz device
+    def update_device(self, idx, svalue, nvalue="0"):
+        url_args = {
+            "type": "command",
+            "param": "udevice",
+            "idx": idx,
+            "nValue": str(nvalue),
+            "svalue": str(svalue),
+        }
+        return self.open_url("/json.htm?" + urlencode(url_args))
+
     def open_url(self, uri, data=None):
         # Generate URL
         url_test = str(self.configuration["domoticz_server"]) + uri
@@ -391,11 +2499,27 @@ class DomoticzInjector:
                 + b64domoticz_password.decode()
             )
 
+        # Name of the domoticz command for the profiler
+        command = re.search(r"param=(\w+)", uri)
+        command = command.group(1) if command else uri
+
+        name = "http domoticz " + command
+        start = time.perf_counter()
         try:
-            response = self.__http.request("GET", url_test)
-        except urllib3.exceptions.MaxRetryError as e:
+            timeout = run_deadline.timeout(self.__timeout)
+            response = self.__http.request("GET", url_test, timeout=timeout, retries=run_deadline.retries(timeout))
+        except urllib3.exceptions.HTTPError as e:
             # HANDLE CONNECTIVITY ERROR
+            profiler.add(name, time.perf_counter() - start, kind="http", error=True)
+            run_deadline.check()
             raise RuntimeError("url=" + url_test + " : " + str(e))
+        profiler.add(name, time.perf_counter() - start, len(response.data), kind="http", error=response.status != 200)
+        query = parse_qs(urlsplit(uri).query)
+        self.last_call = {
+            "idx": (query.get("idx") or query.get("rid") or [None])[0],
+            "value": (query.get("svalue") or query.get("switchcmd") or [None])[0],
+            "latency": round(profiler.calls[-1][1], 4),
+        }
 
         # HANDLE SERVER ERROR CODE
         if not response.status == 200:
@@ -409,12 +2533,15 @@ class DomoticzInjector:
             )
 
         try:
-            j = json.loads(response.data.decode("utf-8"))
+            with profiler.phase("json decode domoticz"):
+                j = json.loads(response.data.decode("utf-8"))
         except Exception as e:
             # Handle JSON ERROR
+            profiler.mark_error(name)
             raise RuntimeError("unable to parse the JSON : " + str(e))
 
         if j["status"].lower() != "ok":
+            profiler.mark_error(name)
             raise RuntimeError(
                 "url="
                 + url_test
@@ -424,6 +2551,8 @@ class DomoticzInjector:
                 + str(j)
             )
 
+        if command in ("udevice", "switchlight"):
+            profiler.count("device updates pushed")
         return j
 
     # Load configuration items
@@ -483,6 +2612,47 @@ class DomoticzInjector:
                 if self.__debug:
                     self.print(st="OK")
 
+    # Check that the device of the idx param exists with the expected type and subtype
+    def _check_device(self, param, dev_type, dev_subtype, hint):
+        response = self.open_url("/json.htm?type=command&param=getdevices&rid=" + str(self.configuration[param]))
+
+        if not "result" in response:
+            raise RuntimeError("device " + str(self.configuration[param])
+                + " could not be found on domoticz server " + str(self.configuration["domoticz_server"]))
+
+        properly_configured = True
+        dev_SubType = response["result"][0]["SubType"]
+        dev_Type = response["result"][0]["Type"]
+        dev_Name = response["result"][0]["Name"]
+
+        # Retrieve Device Name
+        if self.__debug:
+            self.print('    Device Name            : "'+ dev_Name+ '" (idx='+ str(self.configuration[param])+ ")",end="",)
+            self.print(st="ok")
+
+        # Checking Device Type
+        if self.__debug:
+            self.print('    Device Type            : "' + dev_Type + '"', end="")
+        if dev_Type == dev_type:
+            if self.__debug:
+                self.print(st="ok")
+        else:
+            self.print('wrong sensor type. Go to Domoticz/Hardware - ' + hint, st="EE")
+            properly_configured = False
+
+        # Checking device subtype
+        if self.__debug:
+            self.print('    Device SubType         : "' + dev_SubType + '"', end="")
+        if dev_SubType == dev_subtype:
+            if self.__debug:
+                self.print(st="ok")
+        else:
+            self.print('wrong sensor type. Go to Domoticz/Hardware - ' + hint, st="ee")
+            properly_configured = False
+
+        if properly_configured is False:
+            raise RuntimeError("Set your device correctly and run the script again")
+
     def sanity_check(self, debug=False):  
         self.print(
             "Check domoticz connectivity", end=""
@@ -1426,22 +3596,50 @@ class DomoticzInjector:
                         "Set your device correctly and run the script again"
                     )
 
+        #if rolling consumption statistics defined
+        for param in (
+            "domoticz_idx_rolling_trips_electric_consumption",
+            "domoticz_idx_rolling_trips_fuel_consumption",
+            "domoticz_idx_rolling_days_electric_consumption",
+            "domoticz_idx_rolling_days_fuel_consumption",
+        ):
+            if self.configuration[param]:
+                self._check_device(param, "General", "Custom Sensor", 'Create a virtual-sensor type "Custom Sensor"')
+
+        #if charging costs defined
+        for param in ("domoticz_idx_charging_session_cost", "domoticz_idx_charging_total_cost"):
+            if self.configuration[param]:
+                self._check_device(param, "General", "Custom Sensor", 'Create a virtual-sensor type "Custom Sensor"')
+
+        #if charging eta defined
+        if self.configuration["domoticz_idx_charging_eta"]:
+            self._check_device("domoticz_idx_charging_eta", "General", "Text", 'Create a virtual-sensor type "Text"')
+
+        #if trip distributions defined
+        for param in ("domoticz_idx_trip_distance_quantiles", "domoticz_idx_trip_consumption_quantiles"):
+            if self.configuration[param]:
+                self._check_device(param, "General", "Text", 'Create a virtual-sensor type "Text"')
+
 
     #Update all domoticz devices defined in config.json
-    def update_devices(self, vehicleinfo_json_file, vehicletrips_jsonf_file=None, vehiclechargesessions_json=None):
+    # vehicleinfo (VehicleInfo), vehicletrips (Trips) and vehiclechargesessions (ChargeSessions) as parsed by PSACCCrawler
+    # changes : sections of vehicleinfo changed since the last run (SnapshotDiff), all when None
+    def update_devices(self, vehicleinfo, vehicletrips=None, vehiclechargesessions=None, changes=None):
         odometer_update_date = ""
         energy_fuel_update_date = ""
         energy_battery_update_date = ""
         
         #Update odometer or update date if defined 
         if self.configuration["domoticz_idx_odometer"] or self.configuration["domoticz_idx_update_date"]:
-            date_string = vehicleinfo_json_file["timed_odometer"]["updated_at"]
-            date_stringiso=datetime.fromisoformat(date_string)
-            odometer_update_date=date_stringiso.astimezone(datetime.now().astimezone().tzinfo)
+            if vehicleinfo.odometer_updated_at is None:
+                raise RuntimeError("the vehicle info from psacc has no odometer")
+            odometer_update_date=vehicleinfo.odometer_updated_at.astimezone(datetime.now().astimezone().tzinfo)
             
             #Update odometer if defined
-            if self.configuration["domoticz_idx_odometer"]:
-                mileage = int(vehicleinfo_json_file["timed_odometer"]["mileage"])
+            if self.configuration["domoticz_idx_odometer"] and not self.__changed(changes, "odometer"):
+                profiler.count("device updates skipped")
+            elif self.configuration["domoticz_idx_odometer"]:
+                mileage = int(vehicleinfo.mileage)
                 # Generate URL
                 url_args = {
                     "type": "command",
@@ -1455,9 +3653,9 @@ class DomoticzInjector:
                 url_current = "/json.htm?" + urlencode(url_args)
                 if url_current:
                     if self.open_url(url_current):
-                        self.print("update domoticz device odometer "+str(mileage)+" km",st="ok")
+                        self.print("update domoticz device odometer "+str(mileage)+" km",st="ok",fields=self.last_call)
                     else:
-                        self.print("update domoticz device odometer "+str(mileage)+" km",st="EE")
+                        self.print("update domoticz device odometer "+str(mileage)+" km",st="EE",fields=self.last_call)
 
         #Update type of energy if defined (fuel and or electric) and/or autonomy and/or update date and/or charging status
         if (self.configuration["domoticz_idx_battery"] or
@@ -1467,20 +3665,21 @@ class DomoticzInjector:
             self.configuration["domoticz_idx_charging_status"] or
             self.configuration["domoticz_idx_update_date"] or
             self.configuration["domoticz_idx_electric_odometer"] or
-            self.configuration["domoticz_idx_hybrid_odometer"]
+            self.configuration["domoticz_idx_hybrid_odometer"] or
+            self.configuration["domoticz_idx_charging_eta"]
             ):
                 
-            energy_content = vehicleinfo_json_file["energy"]
-            
-            for json_inner_array in energy_content:
-                if json_inner_array["type"] == "Electric" and (self.configuration["domoticz_idx_battery"] or self.configuration["domoticz_idx_update_date"]):
+            for energy in vehicleinfo.energies:
+                energy_changed = self.__changed(changes, "energy " + energy.type)
+                charging_changed = self.__changed(changes, "charging " + energy.type)
+                if energy.type == "Electric" and (self.configuration["domoticz_idx_battery"] or self.configuration["domoticz_idx_update_date"]):
                     
-                    level = int(json_inner_array["level"])
-                    
-                    date_string = json_inner_array["updated_at"]
-                    date_stringiso=datetime.fromisoformat(date_string)
-                    energy_battery_update_date=date_stringiso.astimezone(datetime.now().astimezone().tzinfo)
+                    level = int(energy.level)
+                    energy_battery_update_date=energy.updated_at.astimezone(datetime.now().astimezone().tzinfo)
                     
+                if energy.type == "Electric" and self.configuration["domoticz_idx_battery"] and not energy_changed:
+                    profiler.count("device updates skipped")
+                elif energy.type == "Electric" and self.configuration["domoticz_idx_battery"]:
                     # Generate URL
                     url_args = {
                         "type": "command",
@@ -1493,18 +3692,18 @@ class DomoticzInjector:
                     url_current = "/json.htm?" + urlencode(url_args)
                     if url_current:
                         if self.open_url(url_current):
-                            self.print("update domoticz device battery "+str(level)+" %",st="ok")
+                            self.print("update domoticz device battery "+str(level)+" %",st="ok",fields=self.last_call)
                         else:
-                            self.print("update domoticz device battery "+str(level)+" %",st="EE")
+                            self.print("update domoticz device battery "+str(level)+" %",st="EE",fields=self.last_call)
                              
-                if json_inner_array["type"] == "Electric" and (self.configuration["domoticz_idx_battery_autonomy"] or self.configuration["domoticz_idx_update_date"]):
-                    
-                    autonomy = int(json_inner_array["autonomy"])
+                if energy.type == "Electric" and (self.configuration["domoticz_idx_battery_autonomy"] or self.configuration["domoticz_idx_update_date"]):
                     
-                    date_string = json_inner_array["updated_at"]
-                    date_stringiso=datetime.fromisoformat(date_string)
-                    energy_fuel_update_date=date_stringiso.astimezone(datetime.now().astimezone().tzinfo)
+                    autonomy = int(energy.autonomy)
+                    energy_fuel_update_date=energy.updated_at.astimezone(datetime.now().astimezone().tzinfo)
                     
+                if energy.type == "Electric" and self.configuration["domoticz_idx_battery_autonomy"] and not energy_changed:
+                    profiler.count("device updates skipped")
+                elif energy.type == "Electric" and self.configuration["domoticz_idx_battery_autonomy"]:
                     url_args = {
                         "type": "command",
                         "param": "udevice",
@@ -1516,12 +3715,14 @@ class DomoticzInjector:
                     url_current = "/json.htm?" + urlencode(url_args)
                     if url_current:
                         if self.open_url(url_current):
-                            self.print("update domoticz device battery autonomy "+str(autonomy),st="ok")
+                            self.print("update domoticz device battery autonomy "+str(autonomy),st="ok",fields=self.last_call)
                         else:
-                            self.print("update domoticz device battery autonomy "+str(autonomy),st="EE")
+                            self.print("update domoticz device battery autonomy "+str(autonomy),st="EE",fields=self.last_call)
                 
-                if json_inner_array["type"] == "Fuel" and self.configuration["domoticz_idx_fuel"]:
-                    level = int(json_inner_array["level"])
+                if energy.type == "Fuel" and self.configuration["domoticz_idx_fuel"] and not energy_changed:
+                    profiler.count("device updates skipped")
+                elif energy.type == "Fuel" and self.configuration["domoticz_idx_fuel"]:
+                    level = int(energy.level)
                     # Generate URL
                     url_args = {
                         "type": "command",
@@ -1534,12 +3735,14 @@ class DomoticzInjector:
                     url_current = "/json.htm?" + urlencode(url_args)
                     if url_current:
                         if self.open_url(url_current):
-                            self.print("update domoticz device fuel "+str(level)+" %",st="ok")
+                            self.print("update domoticz device fuel "+str(level)+" %",st="ok",fields=self.last_call)
                         else:
-                            self.print("update domoticz device fuel "+str(level)+" %",st="EE")
+                            self.print("update domoticz device fuel "+str(level)+" %",st="EE",fields=self.last_call)
                 
-                if json_inner_array["type"] == "Fuel" and self.configuration["domoticz_idx_fuel_autonomy"]:
-                    autonomy = int(json_inner_array["autonomy"])
+                if energy.type == "Fuel" and self.configuration["domoticz_idx_fuel_autonomy"] and not energy_changed:
+                    profiler.count("device updates skipped")
+                elif energy.type == "Fuel" and self.configuration["domoticz_idx_fuel_autonomy"]:
+                    autonomy = int(energy.autonomy)
                     # Generate URL
                     url_args = {
                         "type": "command",
@@ -1552,13 +3755,15 @@ class DomoticzInjector:
                     url_current = "/json.htm?" + urlencode(url_args)
                     if url_current:
                         if self.open_url(url_current):
-                            self.print("update domoticz device fuel autonomy "+str(autonomy),st="ok")
+                            self.print("update domoticz device fuel autonomy "+str(autonomy),st="ok",fields=self.last_call)
                         else:
-                            self.print("update domoticz device fuel autonomy "+str(autonomy),st="EE")
+                            self.print("update domoticz device fuel autonomy "+str(autonomy),st="EE",fields=self.last_call)
                 
-                if json_inner_array["type"] == "Electric" and self.configuration["domoticz_idx_charging_status"]:
+                if energy.type == "Electric" and self.configuration["domoticz_idx_charging_status"] and not charging_changed:
+                    profiler.count("device updates skipped")
+                elif energy.type == "Electric" and self.configuration["domoticz_idx_charging_status"]:
                     #Update charging state if defined
-                    charging_state = str(json_inner_array["charging"]["status"])
+                    charging_state = str(energy.charging_status)
                     
                     #Get current domoticz status
                     # Generate URL
@@ -1573,14 +3778,13 @@ class DomoticzInjector:
                     if url_current:
                         domoticz_charging_status_old = self.open_url(url_current)
                         if domoticz_charging_status_old:
-                            self.print("get domoticz device charging status : "+str(domoticz_charging_status_old["result"][0]["Status"]),st="ok")
+                            self.print("get domoticz device charging status : "+str(domoticz_charging_status_old["result"][0]["Status"]),st="ok",fields=self.last_call)
                         else:
-                            self.print("get domoticz device charging status : "+str(domoticz_charging_status_old["result"][0]["Status"]),st="EE")
+                            self.print("get domoticz device charging status : "+str(domoticz_charging_status_old["result"][0]["Status"]),st="EE",fields=self.last_call)
                     
                     current_charging_status = "Off"
                     if charging_state == "InProgress":
                         current_charging_status = "On"
-                        self.force_update = True
                     
                     if domoticz_charging_status_old["result"][0]["Status"] != current_charging_status:
                         # Generate URL
@@ -1595,11 +3799,44 @@ class DomoticzInjector:
                         url_current = "/json.htm?" + urlencode(url_args)
                         if url_current:
                             if self.open_url(url_current):
-                                self.print("update domoticz device charging status : "+str(current_charging_status),st="ok")
+                                self.print("update domoticz device charging status : "+str(current_charging_status),st="ok",fields=self.last_call)
                             else:
-                                self.print("update domoticz device charging status : "+str(current_charging_status),st="EE")
+                                self.print("update domoticz device charging status : "+str(current_charging_status),st="EE",fields=self.last_call)
+                    else:
+                        profiler.count("device updates skipped")
+
+                if (energy.type == "Electric" and self.configuration["domoticz_idx_charging_eta"] and self.charge_eta and
+                    not (energy_changed or charging_changed)
+                ):
+                    profiler.count("device updates skipped")
+                elif energy.type == "Electric" and self.configuration["domoticz_idx_charging_eta"] and self.charge_eta:
+                    #Update charge completion estimated time if defined
+                    if energy.charging:
+                        # start of the session in progress, the last one psacc returns
+                        session = None
+                        if vehiclechargesessions and vehiclechargesessions[-1].stop is None:
+                            session = vehiclechargesessions[-1].start
+                        eta = self.charge_eta.add_sample(energy.updated_at.timestamp(), energy.level, session)
+                        if eta is None:
+                            eta_text = "estimating..."
+                        else:
+                            eta_datetime = datetime.fromtimestamp(eta).astimezone()
+                            eta_text = (str(self.charge_eta.target_level) + "% at " + eta_datetime.strftime("%H:%M")
+                                + " (in " + str(timedelta(seconds=int(max(0, eta - time.time())) // 60 * 60))[:-3] + ")")
+                        publish = True
+                    else:
+                        # Only publish once at the end of the session
+                        eta_text = "not charging"
+                        publish = self.charge_eta.reset()
+                    if publish:
+                        if self.update_device(self.configuration["domoticz_idx_charging_eta"], eta_text):
+                            self.print("update domoticz device charging eta : "+eta_text,st="ok",fields=self.last_call)
+                        else:
+                            self.print("update domoticz device charging eta : "+eta_text,st="EE",fields=self.last_call)
+                    else:
+                        profiler.count("device updates skipped")
         
-        #Udpate date and verification of force update if charging
+        #Udpate date
         if self.__debug:
             self.print("update domoticz device Odometer update date "+str(odometer_update_date),st="ok")
             self.print("update domoticz device Fuel update date "+str(energy_fuel_update_date),st="ok")
@@ -1609,14 +3846,13 @@ class DomoticzInjector:
             most_recent_update_date = energy_fuel_update_date
         if most_recent_update_date < odometer_update_date: 
             most_recent_update_date = odometer_update_date
-        
-        if self.force_update:
-            #verification of the last update date to be sure
-            if (most_recent_update_date+timedelta(minutes=10)) > datetime.now(most_recent_update_date.now().astimezone().tzinfo):
-                self.force_update = False
-            
+
         #Update "update date" if defined
-        if self.configuration["domoticz_idx_update_date"]:
+        if self.configuration["domoticz_idx_update_date"] and changes is not None and not any(
+            section.startswith(("odometer", "energy ")) for section in changes
+        ):
+            profiler.count("device updates skipped")
+        elif self.configuration["domoticz_idx_update_date"]:
             # Generate URL
             url_args = {
                 "type": "command",
@@ -1630,13 +3866,17 @@ class DomoticzInjector:
             url_current = "/json.htm?" + urlencode(url_args)
             if url_current:
                 if self.open_url(url_current):
-                    self.print("update domoticz device update date "+str(most_recent_update_date),st="ok")
+                    self.print("update domoticz device update date "+str(most_recent_update_date),st="ok",fields=self.last_call)
                 else:
-                    self.print("update domoticz device update date "+str(most_recent_update_date),st="EE")
+                    self.print("update domoticz device update date "+str(most_recent_update_date),st="EE",fields=self.last_call)
                         
         #Update air temperature if defined
-        if self.configuration["domoticz_idx_air_temperature"]:
-            temperature = int(vehicleinfo_json_file["environment"]["air"]["temp"])
+        if self.configuration["domoticz_idx_air_temperature"] and not self.__changed(changes, "environment"):
+            profiler.count("device updates skipped")
+        elif self.configuration["domoticz_idx_air_temperature"]:
+            if vehicleinfo.air_temperature is None:
+                raise RuntimeError("the vehicle info from psacc has no air temperature")
+            temperature = int(vehicleinfo.air_temperature)
             
             # Generate URL
             url_args = {
@@ -1651,30 +3891,22 @@ class DomoticzInjector:
             url_current = "/json.htm?" + urlencode(url_args)
             if url_current:
                 if self.open_url(url_current):
-                    self.print("update domoticz device air temperature "+str(temperature)+" °C",st="ok")
+                    self.print("update domoticz device air temperature "+str(temperature)+" °C",st="ok",fields=self.last_call)
                 else:
-                    self.print("update domoticz device air temperature "+str(temperature)+" °C",st="EE")
+                    self.print("update domoticz device air temperature "+str(temperature)+" °C",st="EE",fields=self.last_call)
 
         #Update electric only odometer and hybrid/fuel odomoter
         if ((self.configuration["domoticz_idx_electric_odometer"] or self.configuration["domoticz_idx_hybrid_odometer"]) and 
-        vehicletrips_jsonf_file
+        vehicletrips
         ):
             total_electrical_distance = 0.0    
             total_hybrid_distance = 0.0    
             
-            for json_inner_array in vehicletrips_jsonf_file:
-                consumption_fuel_km = float(json_inner_array["consumption_fuel_km"])
-                consumption_electric_km = float(json_inner_array["consumption_km"])
-                distance = float(json_inner_array["distance"])
-                    
-                date_string=datetime.strptime(json_inner_array["start_at"], '%a, %d %b %Y %H:%M:%S %Z')
-                update_dateLocal=date_string.astimezone(datetime.now().astimezone().tzinfo) #apply local timezone
-                
-                
-                if(consumption_fuel_km==0):
-                    total_electrical_distance=total_electrical_distance+distance
+            for trip in vehicletrips:
+                if(trip.consumption_fuel_km==0):
+                    total_electrical_distance=total_electrical_distance+trip.distance
                 else:
-                    total_hybrid_distance = total_hybrid_distance + distance
+                    total_hybrid_distance = total_hybrid_distance + trip.distance
                 
             
             total_electrical_distance=round(total_electrical_distance,2)
@@ -1692,9 +3924,9 @@ class DomoticzInjector:
                 url_current = "/json.htm?" + urlencode(url_args)
                 if url_current:
                     if self.open_url(url_current):
-                        self.print("update domoticz electric only odometer "+str(total_electrical_distance)+" km",st="ok")
+                        self.print("update domoticz electric only odometer "+str(total_electrical_distance)+" km",st="ok",fields=self.last_call)
                     else:
-                        self.print("update domoticz electric only odometer "+str(total_electrical_distance)+" km",st="EE")
+                        self.print("update domoticz electric only odometer "+str(total_electrical_distance)+" km",st="EE",fields=self.last_call)
                         
             if self.configuration["domoticz_idx_hybrid_odometer"]:
                 url_args = {
@@ -1708,58 +3940,82 @@ class DomoticzInjector:
                 url_current = "/json.htm?" + urlencode(url_args)
                 if url_current:
                     if self.open_url(url_current):
-                        self.print("update domoticz hybrid mode odometer "+str(total_hybrid_distance)+" km",st="ok")
+                        self.print("update domoticz hybrid mode odometer "+str(total_hybrid_distance)+" km",st="ok",fields=self.last_call)
                     else:
-                        self.print("update domoticz hybrid mode odometer "+str(total_hybrid_distance)+" km",st="EE")
+                        self.print("update domoticz hybrid mode odometer "+str(total_hybrid_distance)+" km",st="EE",fields=self.last_call)
                
                         
-        #Update vehicle charging sessions
-        if (vehiclechargesessions_json):
-            charging_kw = 0.0    
-            total_hybrid_distance = 0.0    
-            
-            for json_inner_array in vehiclechargesessions_json:
-                #consumption_fuel_km = float(json_inner_array["consumption_fuel_km"])
-                #consumption_electric_km = float(json_inner_array["consumption_km"])
-                #distance = float(json_inner_array["distance"])
-                    
-                if (json_inner_array["stop_at"]):
-                    date_string_start=datetime.strptime(json_inner_array["start_at"], '%a, %d %b %Y %H:%M:%S %Z')
-                    update_dateLocal_start=date_string_start.astimezone(datetime.now().astimezone().tzinfo) #apply local timezone
-                    date_string_stop=datetime.strptime(json_inner_array["stop_at"], '%a, %d %b %Y %H:%M:%S %Z')
-                    update_dateLocal_stop=date_string_stop.astimezone(datetime.now().astimezone().tzinfo) #apply local timezone
-                    charging_kw=charging_kw+json_inner_array["kw"]
-                    #charging_price=json_inner_array["price"]
-                    self.print("update domoticz vehiclechargesessions_json "+str(charging_kw)+"kwh ",st="ok")
-                
-                
-                if(consumption_fuel_km==0):
-                    total_electrical_distance=total_electrical_distance+distance
-                else:
-                    total_hybrid_distance = total_hybrid_distance + distance
-                
-            
-            total_electrical_distance=round(total_electrical_distance,2)
-            total_hybrid_distance=round(total_hybrid_distance,2)
-            # Generate URL
-            if self.configuration["domoticz_idx_electric_odometer"]:
-                url_args = {
-                    "type": "command",
-                    "param": "udevice",
-                    "idx": self.configuration["domoticz_idx_charging_consumption"],
-                    "nValue":"0",
-                    "svalue": str(charging_kw),
-                }
-                # Update Current value
-                url_current = "/json.htm?" + urlencode(url_args)
-                if url_current:
-                    if self.open_url(url_current):
-                        self.print("update domoticz charging consumption "+str(charging_kw)+" kwh",st="ok")
+        #Update vehicle charging sessions consumption and cost if defined
+        if ((self.configuration["domoticz_idx_charging_consumption"] or
+            self.configuration["domoticz_idx_charging_session_cost"] or
+            self.configuration["domoticz_idx_charging_total_cost"]) and
+            vehiclechargesessions and self.charge_accounting
+        ):
+            charging, changed = self.charge_accounting.process(vehiclechargesessions)
+            if changed:
+                pushed = True
+                for param, value, label in (
+                    ("domoticz_idx_charging_consumption", charging["total_kw"], "charging consumption "+str(charging["total_kw"])+" kwh"),
+                    ("domoticz_idx_charging_session_cost", charging["last_cost"], "charging session cost "+str(charging["last_cost"])),
+                    ("domoticz_idx_charging_total_cost", charging["total_cost"], "charging total cost "+str(charging["total_cost"])),
+                ):
+                    if self.configuration[param]:
+                        if self.update_device(self.configuration[param], value):
+                            self.print("update domoticz "+label,st="ok",fields=self.last_call)
+                        else:
+                            pushed = False
+                            self.print("update domoticz "+label,st="EE",fields=self.last_call)
+                if pushed:
+                    self.charge_accounting.commit()
+            else:
+                profiler.count("device updates skipped")
+                if self.__debug:
+                    self.print("domoticz charging consumption unchanged "+str(charging["total_kw"])+" kwh",st="ok")
+
+        #Update rolling consumption statistics if defined
+        if ((self.configuration["domoticz_idx_rolling_trips_electric_consumption"] or
+            self.configuration["domoticz_idx_rolling_trips_fuel_consumption"] or
+            self.configuration["domoticz_idx_rolling_days_electric_consumption"] or
+            self.configuration["domoticz_idx_rolling_days_fuel_consumption"]) and
+            vehicletrips and self.rolling_consumption
+        ):
+            trips_consumption, days_consumption = self.rolling_consumption.process(vehicletrips)
+            for param, consumption, index, unit in (
+                ("domoticz_idx_rolling_trips_electric_consumption", trips_consumption, 0, "kwh/100km"),
+                ("domoticz_idx_rolling_trips_fuel_consumption", trips_consumption, 1, "l/100km"),
+                ("domoticz_idx_rolling_days_electric_consumption", days_consumption, 0, "kwh/100km"),
+                ("domoticz_idx_rolling_days_fuel_consumption", days_consumption, 1, "l/100km"),
+            ):
+                if self.configuration[param] and consumption is not None:
+                    label = "update domoticz " + param[len("domoticz_idx_"):].replace("_", " ") + " " + str(consumption[index]) + " " + unit
+                    if self.update_device(self.configuration[param], consumption[index]):
+                        self.print(label,st="ok",fields=self.last_call)
+                    else:
+                        self.print(label,st="EE",fields=self.last_call)
+
+        #Update trip distance and consumption distributions if defined
+        if ((self.configuration["domoticz_idx_trip_distance_quantiles"] or
+            self.configuration["domoticz_idx_trip_consumption_quantiles"]) and
+            vehicletrips and self.trip_distributions
+        ):
+            distance_quantiles, consumption_quantiles = self.trip_distributions.process(vehicletrips)
+            for param, quantiles, unit in (
+                ("domoticz_idx_trip_distance_quantiles", distance_quantiles, "km"),
+                ("domoticz_idx_trip_consumption_quantiles", consumption_quantiles, "kWh/100km"),
+            ):
+                if self.configuration[param] and quantiles is not None:
+                    text = "median " + str(quantiles[0]) + " " + unit + " - p90 " + str(quantiles[1]) + " " + unit
+                    label = "update domoticz " + param[len("domoticz_idx_"):].replace("_", " ") + " " + text
+                    if self.update_device(self.configuration[param], text):
+                        self.print(label,st="ok",fields=self.last_call)
                     else:
-                        self.print("update domoticz charging consumption "+str(charging_kw)+" kwh",st="EE")
-                         
+                        self.print(label,st="EE",fields=self.last_call)
+
 
 def exit_on_error(psacc_obj=None, domoticz=None, string="", debug=False):
+    if run_deadline.interrupted is not None:
+        exit_on_deadline(string)
+
     try:
         o
     except:
@@ -1779,31 +4035,256 @@ def exit_on_error(psacc_obj=None, domoticz=None, string="", debug=False):
     sys.exit(2)
 
 
-def check_new_script_version():
-    o.print("Check script version is up to date", end="")
+# Main phases of a run, in order, to report what was left undone
+RUN_PHASES = [
+    "sanity_check",
+    "fetch get_vehicleinfo",
+    "fetch get_vehicletrips",
+    "fetch get_vehiclechargesessions",
+    "update_devices (aggregation and push)",
+    "state save",
+]
+
+def record_unfinished(string="", phases=RUN_PHASES):
+    # Keep what has been done (state) and record what has not
+    undone = [phase for phase in phases if phase not in profiler.entries]
+    if run_deadline.interrupted and run_deadline.interrupted not in undone:
+        undone.insert(0, run_deadline.interrupted + " (interrupted)")
+    o.print(string + " - not done : " + ", ".join(undone), st="WW")
     try:
-        http = urllib3.PoolManager()
-        user_agent = {"user-agent": "psacc-domoticz - " + VERSION}
-        r = http.request(
-            "GET",
-            "https://api.github.com/repos/Tatroxitum/psacc-domoticz/releases/latest",
-            headers=user_agent,
-        )
-        j = json.loads(r.data.decode("utf-8"))
-    except Exception:
-        raise
+        state
+    except NameError:
+        pass
     else:
-        if j["tag_name"] > VERSION:
-            o.print(
+        try:
+            state.section("last_run")["unfinished"] = {"at": time.time(), "phases": undone}
+            state.save()
+        except Exception as exc:
+            o.print("unable to save the state : " + str(exc), st="WW")
+
+
+def exit_on_deadline(string=""):
+    record_unfinished(string)
+    o.print("Stopped at the run deadline, the run will go on at the next start", st="WW")
+    sys.exit(3)
+
+
+# Fetch the vehicle data from psacc, update domoticz and save the state
+def run_pipeline(psaccserver, domoticzserver, state, metrics, scheduler=None, freshness=None, snapshots=None):
+    # Get informations from psacc server
+    with profiler.phase("fetch get_vehicleinfo"):
+        fromcache = freshness.use_cache() if freshness else True
+        vehicleinfo = psaccserver.get_vehicleinfo(fromcache=fromcache)
+        if freshness:
+            freshness.observe(vehicleinfo, fromcache)
+    with profiler.phase("fetch get_vehicletrips"):
+        vehicletrips = psaccserver.get_vehicletrips()
+    with profiler.phase("fetch get_vehiclechargesessions"):
+        charge_accounting = domoticzserver.charge_accounting
+        vehiclechargesessions = psaccserver.get_vehiclechargesessions(
+            since=charge_accounting.since() if charge_accounting else None
+        )
+
+    # Update domoticz
+    with profiler.phase("update_devices (aggregation and push)"):
+        changes = snapshots.diff(vehicleinfo) if snapshots else None
+        domoticzserver.update_devices(vehicleinfo,vehicletrips,vehiclechargesessions,changes)
+        if snapshots:
+            snapshots.commit()
+    wakeup_reason = freshness.wakeup_reason(vehicleinfo) if freshness else None
+    if wakeup_reason:
+        #force vehicule update and redo
+        o.print("force update is true", st="WW") 
+        if run_deadline.remaining() < 90 + 30:
+            o.print("not enough time left before the run deadline to wait for the vehicle update", st="WW")
+        else:
+            with profiler.phase("wakeup"):
+                wakeup_at = psaccserver.force_vehicle_update(wakeup_reason)
+                # a wakeup merged with a pending one may already show in the vehicle data
+                if wakeup_at is not None and (FreshnessPolicy.data_date(vehicleinfo) or 0) < wakeup_at:
+                    wait = max(0, wakeup_at + 90 - time.time())
+                    o.print("waiting for " + str(int(wait)) + " seconds", st="WW")
+                    time.sleep(wait) #wait 90 sec after the wakeup for update of the server
+                    # the data sent by the vehicle reaches the psacc cache, a live read stays within the freshness budget
+                    fromcache = freshness.use_cache() if freshness else False
+                    vehicleinfo = psaccserver.get_vehicleinfo(fromcache=fromcache)
+                    if freshness:
+                        freshness.observe(vehicleinfo, fromcache)
+                    changes = snapshots.diff(vehicleinfo) if snapshots else None
+                    domoticzserver.update_devices(vehicleinfo, changes=changes)
+                    if snapshots:
+                        snapshots.commit()
+
+    if scheduler:
+        scheduler.plan(psaccserver.vehicleinfo, vehicletrips)
+
+    # Save the state for the next run
+    with profiler.phase("state save"):
+        state.section("last_run").pop("unfinished", None)
+        state.save()
+
+
+# Watch mode : run the pipeline as soon as psacc writes new data in its files,
+# and at least every "watch_max_interval" seconds
+def watch(
+    psaccserver, domoticzserver, state, metrics, configuration, version_checker=None, scheduler=None, freshness=None,
+    snapshots=None, debug=False
+):
+    files = configuration.get("watch_files") or (
+        [configuration["psacc_database"]] if configuration.get("psacc_database") else []
+    )
+    if not files:
+        raise RuntimeError('"watch_files" (or "psacc_database") is needed by the watch mode')
+    watcher = DataWatcher(files, configuration.get("watch_debounce", 10), super_print=o.print, debug=debug)
+    max_interval = float(configuration.get("watch_max_interval", 600))
+    budget = run_deadline.budget
+
+    # The metrics are exported after each run instead of at exit
+    if metrics.enabled():
+        atexit.unregister(export_metrics)
+        if metrics.port:
+            metrics.serve()
+
+    o.print("Watching " + ", ".join(watcher.files))
+    while True:
+        start = time.perf_counter()
+        metrics.success = False
+        try:
+            run_pipeline(psaccserver, domoticzserver, state, metrics, scheduler, freshness, snapshots)
+            metrics.success = True
+            o.print("Updated on success")
+        except Exception as exc:
+            if run_deadline.interrupted is not None:
+                record_unfinished(str(exc), RUN_PHASES[1:])
+            else:
+                o.print(str(exc), st="EE")
+
+        if version_checker:
+            version_checker.report()
+            version_checker = None
+        if metrics.enabled():
+            try:
+                metrics.collect_run(profiler, time.perf_counter() - start)
+                metrics.write_textfile()
+            except Exception as exc:
+                o.print("unable to export prometheus metrics : " + str(exc), st="WW")
+
+        # the adaptive schedule replaces the maximum interval, the changes of the files still trigger an update
+        watcher.wait(max(1.0, scheduler.due_in()) if scheduler else max_interval)
+        profiler.reset()
+        run_deadline.start(budget)
+
+
+def print_profile_report(cprofile=None, pstats_file=None):
+    if cprofile is not None:
+        cprofile.disable()
+        if pstats_file:
+            cprofile.dump_stats(pstats_file)
+    print("")
+    for line in profiler.report(time.perf_counter() - IMPORT_START):
+        print(line)
+    if cprofile is not None and pstats_file:
+        print("cProfile statistics saved to " + pstats_file + " (python3 -m pstats " + pstats_file + ")")
+
+
+def export_metrics(metrics):
+    try:
+        metrics.collect_run(profiler, time.perf_counter() - IMPORT_START)
+        metrics.write_textfile()
+    except Exception as exc:
+        o.print("unable to export prometheus metrics : " + str(exc), st="WW")
+
+
+def check_new_script_version(timeout=5):
+    user_agent = {"user-agent": "psacc-domoticz - " + VERSION}
+    start = time.perf_counter()
+    r = http_client().request(
+        "GET",
+        "https://api.github.com/repos/Tatroxitum/psacc-domoticz/releases/latest",
+        headers=user_agent,
+        retries=False,
+        timeout=timeout,
+    )
+    profiler.add("http github releases/latest", time.perf_counter() - start, len(r.data), kind="http", error=r.status != 200)
+    j = json.loads(r.data.decode("utf-8"))
+    return {"tag_name": j["tag_name"], "name": j["name"], "checked_at": time.time()}
+
+
+################################################################################
+# Check of the latest release, cached and out of the critical path of the run
+################################################################################
+class VersionChecker:
+    # The latest release is cached for "ttl" seconds. When the cache is stale
+    # the check runs in a background thread with a short timeout, its result
+    # is reported at the end of the run (or at the next run if still pending).
+    # A failure of the check never stops the run.
+    def __init__(self, cache_folder=None, ttl=86400, super_print=None, debug=False):
+        self.__debug = debug
+
+        # Supersede local print function if provided as an argument
+        self.print = super_print if super_print else self.print
+
+        self.ttl = ttl
+        self.__store = StateStore(cache_folder, super_print=super_print, debug=debug, filename="psacc-domoticz.version.json")
+        self.cache = self.__store.section("latest_release")
+        self.__thread = None
+        self.__error = None
+
+    def start(self):
+        if self.cache.get("checked_at", 0) + self.ttl > time.time():
+            self.print("Check script version is up to date (cached)", end="")
+            self.__report()
+            return
+        # Do not retry at each run when github is unreachable
+        if self.cache.get("failed_at", 0) + 3600 > time.time():
+            return
+        if self.__debug:
+            self.print("Check script version in background", st="ok")
+        self.__thread = threading.Thread(target=self.__check, daemon=True)
+        self.__thread.start()
+
+    def __check(self):
+        try:
+            self.cache.update(check_new_script_version())
+            self.cache.pop("failed_at", None)
+        except Exception as exc:
+            self.__error = exc
+            self.cache["failed_at"] = time.time()
+        try:
+            self.__store.save()
+        except Exception:
+            pass
+
+    # Report the result of the background check if it has completed
+    def report(self):
+        if self.__thread is None or self.__thread.is_alive():
+            return
+        self.__thread = None
+        self.print("Check script version is up to date", end="")
+        if self.__error is not None:
+            self.print("unable to check the latest version : " + str(self.__error), st="ww")
+        else:
+            self.__report()
+
+    def __report(self):
+        if self.cache.get("tag_name", "") > VERSION:
+            self.print(
                 'New version "'
-                + j["name"]
+                + self.cache["name"]
                 + '"('
-                + j["tag_name"]
+                + self.cache["tag_name"]
                 + ") available. Check : https://github.com/Tatroxitum/psacc-domoticz/releases/latest",
                 st="ww",
             )
         else:
-            o.print(st="ok")
+            self.print(st="ok")
+
+    def print(self, string="", st=None, end=None):
+        st = "[" + st + "] " if st else ""
+        if end is None:
+            print(st + string)
+        else:
+            print(st + string + " ", end="", flush="True")
 
 
 if __name__ == "__main__":
@@ -1846,76 +4327,200 @@ if __name__ == "__main__":
         help="run the script",
         required=True,
     )
+    parser.add_argument(
+        "--log-format",
+        help="format of the log file : text (default) or json lines with the run id, phase, device idx, value, latency and status",
+        choices=["text", "json"],
+        default="text",
+    )
+    parser.add_argument(
+        "--profile",
+        help="print the time spent in each phase of the run, and save the cProfile statistics of the whole run in PSTATS_FILE if given",
+        metavar="PSTATS_FILE",
+        nargs="?",
+        const=True,
+        default=False,
+    )
+    parser.add_argument(
+        "--watch",
+        help="keep running and update domoticz as soon as psacc writes new data in \"watch_files\" (or \"psacc_database\")",
+        action="store_true",
+    )
+    traffic = parser.add_mutually_exclusive_group()
+    traffic.add_argument(
+        "--record",
+        help="save every psacc and domoticz response of the run in RECORD_DIR, to be replayed with --replay",
+        metavar="RECORD_DIR",
+    )
+    traffic.add_argument(
+        "--replay",
+        help="serve the psacc and domoticz responses from RECORD_DIR (saved with --record) instead of the network",
+        metavar="RECORD_DIR",
+    )
+    parser.add_argument(
+        "--replay-latency",
+        help="latency in milliseconds added to each replayed call, or 'recorded' for the latency of the recording (0)",
+        default="0",
+    )
     args = parser.parse_args()
 
+    # Profile the run, the report is printed whatever the way the script exits
+    if args.profile:
+        cprofile = None
+        pstats_file = args.profile if args.profile is not True else None
+        if pstats_file:
+            import cProfile
+            cprofile = cProfile.Profile()
+            cprofile.enable()
+        atexit.register(print_profile_report, cprofile, pstats_file)
+
     # Init output
     try:
         o = Output(
-            logs_folder=str(args.logs_folder).strip("[]'"), debug=args.debug
+            logs_folder=str(args.logs_folder).strip("[]'"), debug=args.debug, json_lines=args.log_format == "json"
         )
     except Exception as exc:
         exit_on_error(string=str(exc), debug=args.debug)
 
+    # Record or replay the http traffic
+    try:
+        if args.record:
+            shared_http_client = TrafficRecorder(args.record, http_client())
+            o.print("recording the http traffic in " + args.record, st="WW")
+        elif args.replay:
+            latency = args.replay_latency
+            shared_http_client = TrafficReplayer(
+                args.replay, latency if latency == "recorded" else float(latency) / 1000
+            )
+            o.print("replaying the http traffic from " + args.replay, st="WW")
+    except Exception as exc:
+        exit_on_error(string="unable to record or replay the http traffic : " + str(exc), debug=args.debug)
+
     # Print debug message
     if args.debug:
         o.print("DEBUG MODE ACTIVATED", end="")
         o.print("only use '--debug' for troubleshooting", st="WW")
 
-    # New version checking
+    # Load configuration
     try:
-        check_new_script_version()
+        with profiler.phase("config load"):
+            c = Configuration(debug=args.debug, super_print=o.print)
+            configuration_json = c.load_configuration_file(
+                str(args.config).strip("[]'")
+            )
+            configuration_json["logs_folder"] = str(args.logs_folder).strip("[]'")
     except Exception as exc:
         exit_on_error(string=str(exc), debug=args.debug)
 
-    # Load configuration
+    # Adaptive schedule : a run started before the next update is due exits at once.
+    # Only the date of the next update is read here, the state used by the run
+    # is loaded once the lock is held : a run waiting for the lock must not
+    # save over what the previous run saved
     try:
-        c = Configuration(debug=args.debug, super_print=o.print)
-        configuration_json = c.load_configuration_file(
-            str(args.config).strip("[]'")
-        )
-        configuration_json["logs_folder"] = str(args.logs_folder).strip("[]'")
+        adaptive = configuration_json.get("schedule", "fixed") == "adaptive"
+        if adaptive and not args.watch:
+            schedule = PollScheduler(
+                configuration_json,
+                StateStore(configuration_json.get("download_folder"), super_print=o.print, debug=args.debug),
+                super_print=o.print, debug=args.debug,
+            )
+            # a run started a little before the due time (cron granularity) goes on
+            if schedule.due_in() > 30:
+                if args.debug:
+                    o.print("Next update is due in " + str(int(schedule.due_in())) + "s, exiting")
+                sys.exit(0)
     except Exception as exc:
         exit_on_error(string=str(exc), debug=args.debug)
 
-    # Create objects
+    # Deadline of the whole run, and lock to prevent overlapping runs
+    try:
+        run_deadline.start(float(configuration_json.get("run_deadline", 300)))
+        run_lock = RunLock(configuration_json.get("download_folder"))
+        lock_wait = 0
+        if configuration_json.get("run_lock", "exit") == "wait":
+            lock_wait = max(0, run_deadline.remaining() - 60)
+        if not run_lock.acquire(wait=lock_wait):
+            o.print("Another run is in progress (" + run_lock.lock_file + "), exiting", st="WW")
+            sys.exit(0)
+        atexit.register(run_lock.release)
+    except Exception as exc:
+        exit_on_error(string=str(exc), debug=args.debug)
+
+    # State of the incremental computations, loaded under the lock
     try:
-        psaccserver = PSACCCrawler(
-            configuration_json, super_print=o.print, debug=args.debug
+        state = StateStore(
+            configuration_json.get("download_folder"), super_print=o.print, debug=args.debug
         )
-        domoticzserver = DomoticzInjector(
-            configuration_json, super_print=o.print, debug=args.debug
+        scheduler = None
+        if adaptive:
+            scheduler = PollScheduler(configuration_json, state, super_print=o.print, debug=args.debug)
+    except Exception as exc:
+        exit_on_error(string=str(exc), debug=args.debug)
+
+    # New version checking, never blocks nor fails the run
+    try:
+        with profiler.phase("check_new_script_version"):
+            version_checker = VersionChecker(
+                configuration_json.get("download_folder"), super_print=o.print, debug=args.debug
+            )
+            version_checker.start()
+    except Exception as exc:
+        o.print("unable to check the latest version : " + str(exc), st="WW")
+        version_checker = None
+
+    # Export the metrics of the run whatever the way the script exits
+    try:
+        metrics = MetricsExporter(
+            configuration_json, configuration_json.get("download_folder"), super_print=o.print, debug=args.debug
         )
+        if metrics.enabled():
+            atexit.register(export_metrics, metrics)
     except Exception as exc:
         exit_on_error(string=str(exc), debug=args.debug)
 
-    # Check requirements on domoticz
+    # Create objects
     try:
-        domoticzserver.sanity_check(args.debug)
+        with profiler.phase("setup"):
+            psaccserver = PSACCCrawler(
+                configuration_json, super_print=o.print, debug=args.debug
+            )
+            freshness = FreshnessPolicy(configuration_json, state, super_print=o.print, debug=args.debug)
+            snapshots = SnapshotDiff(
+                state, configuration_json.get("snapshot_max_age", 1800), super_print=o.print, debug=args.debug
+            )
+            snapshots.subscribe(metrics.vehicle_changed)
+            domoticzserver = DomoticzInjector(
+                configuration_json, super_print=o.print, debug=args.debug, state=state
+            )
     except Exception as exc:
-        exit_on_error(psaccserver, domoticzserver, str(exc), debug=args.debug)
+        exit_on_error(string=str(exc), debug=args.debug)
 
-    # Get informations from psacc server
+    # Check requirements on domoticz
     try:
-        vehicleinfo_json = psaccserver.get_vehicleinfo()
-        vehicletrips_json = psaccserver.get_vehicletrips()
-        vehiclechargesessions_json = psaccserver.get_vehiclechargesessions()
+        with profiler.phase("sanity_check"):
+            domoticzserver.sanity_check(args.debug)
     except Exception as exc:
         exit_on_error(psaccserver, domoticzserver, str(exc), debug=args.debug)
-    
-    # Update domoticz
+
+    # Watch mode, never returns
+    if args.watch:
+        try:
+            watch(
+                psaccserver, domoticzserver, state, metrics, configuration_json, version_checker, scheduler, freshness,
+                snapshots, debug=args.debug,
+            )
+        except Exception as exc:
+            exit_on_error(psaccserver, domoticzserver, str(exc), debug=args.debug)
+
+    # Get informations from psacc server and update domoticz
     try:
-        domoticzserver.update_devices(vehicleinfo_json,vehicletrips_json,vehiclechargesessions_json)
-        if domoticzserver.force_update == True:
-            #force vehicule update and redo
-            o.print("force update is true", st="WW") 
-            if psaccserver.force_vehicle_update():
-                o.print("waiting for 90 seconds", st="WW") 
-                time.sleep(90) #wait 90 sec for update of the server
-                get_vehicleinfo_json = psaccserver.get_vehicleinfo(fromcache=False)
-                domoticzserver.update_devices(vehicleinfo_json)
-    
+        run_pipeline(psaccserver, domoticzserver, state, metrics, scheduler, freshness, snapshots)
     except Exception as exc:
         exit_on_error(psaccserver, domoticzserver, str(exc), debug=args.debug)
 
+    if version_checker:
+        version_checker.report()
+
+    metrics.success = True
     o.print("Finished on success")
     sys.exit(0)